@@ -0,0 +1,338 @@
+""" Benchmarks of coop.py subcommands against a local stand-in for butik.mad.coop.dk.
+
+The mock server answers the endpoints Coop uses with synthetic responses,
+with configurable latency and failure rate. Each scenario runs a subcommand
+in a fresh directory, first cold and then warm (with the caches from the
+first run), and reports wall time and the requests that reached the server.
+
+    python3 bench.py --latency 50 --out bench.json
+"""
+import argparse
+import collections
+import contextlib
+import datetime
+import http.server
+import io
+import json
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import coop
+
+
+class MockShop:
+    """ State of the fake shop: products, stock, a basket and an order history """
+
+    def __init__(self, n_products=5000, n_orders=60, seed=0):
+        rnd = random.Random(seed)
+        self.products = {}
+        for i in range(n_products):
+            pid = str(5700000000000 + i)
+            self.products[pid] = dict(
+                id=pid, displayName=f'Vare {i}', category=f'Kategori {i % 20}',
+                spotText=f'{rnd.randint(1, 9)} stk', labels=[], url=f'/varer/{pid}',
+                isInAssortment=i % 100 != 99, salesPrice=dict(amount=rnd.randint(5, 200)))
+        self.stock = {pid: 0 if rnd.random() < .15 else rnd.randint(1, 50)
+                      for pid in self.products}
+        self.orders = [dict(orderIdentifier=f'order{i}', orderNumber=10000 + i,
+                            deliveryTime=f'{i % 28 + 1}. januar', isEditable=i == n_orders - 1,
+                            price=dict(formattedAmount=f'{rnd.randint(300, 1500)},00'))
+                       for i in range(n_orders)]
+        pids = list(self.products)
+        self.order_items = {o['orderIdentifier']: rnd.sample(pids, 40) for o in self.orders}
+        self.basket = {}
+        self.lock = threading.Lock()
+
+    def basket_json(self):
+        return dict(
+            id=1, orderIdentifier='current',
+            timeSlot=dict(timeSlotId='slot1', deliveryDescription='onsdag 17-18'),
+            store=dict(id=1, address='Benchvej 1'),
+            lineItems=[dict(quantity=q, product=self.products[pid])
+                       for pid, q in self.basket.items()],
+            progressBar=dict(achievement=''),
+            totals=dict(subTotal=dict(formattedAmountLong='0,00')))
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, obj, status=200, content_type='application/json', headers=()):
+        body = (obj if isinstance(obj, str) else json.dumps(obj)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_one(self, method):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        param = {k: v[0] for k, v in query.items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with server.lock:
+            server.counts[url.path] += 1
+        time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+        if random.random() < server.fail_rate:
+            return self.reply({'Message': 'Service unavailable'}, 503, headers=[('Retry-After', '0')])
+        authenticated = 'auth=1' in (self.headers.get('Cookie') or '')
+        handler = getattr(self, method + '_' + url.path.strip('/').replace('/', '_').replace('-', '_').lower(), None)
+        if handler is None:
+            return self.reply({'Message': f'No mock for {url.path}'}, 404)
+        if url.path.startswith('/api/') and 'authentication' not in url.path and not authenticated:
+            return self.reply({'Message': 'Authorization has been denied for this request.'}, 401)
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            data = json.loads(body or b'{}')
+        else:
+            data = dict(urllib.parse.parse_qsl(body.decode()))
+        return handler(param, query, data, authenticated)
+
+    def do_GET(self):
+        self.handle_one('get')
+
+    def do_POST(self):
+        self.handle_one('post')
+
+    # Login pages, shaped like the real ones
+
+    def get_api_authentication_loginsrc(self, param, query, data, authenticated):
+        action = f'{self.server.base}Account/Login?ReturnUrl=%2Fconnect'
+        self.reply(f'''<html><body><div><div><form action="{action}" method="post">
+            <input name="__RequestVerificationToken" type="hidden" value="token">
+            </form></div></div></body></html>''', content_type='text/html')
+
+    def post_account_login(self, param, query, data, authenticated):
+        if data.get('Password') != 'bench':
+            return self.reply('<html><body>Adgangskoden er forkert</body></html>',
+                              content_type='text/html')
+        self.reply(f'''<html><body><form method="post" action="{self.server.base}login/callback">
+            <input type="hidden" name="code" value="code">
+            <input type="hidden" name="state" value="state">
+            </form></body></html>''', content_type='text/html')
+
+    def post_login_callback(self, param, query, data, authenticated):
+        self.reply('<html><body></body></html>', content_type='text/html',
+                   headers=[('Set-Cookie', 'auth=1; Path=/')])
+
+    def get_min_profil_profiloplysninger(self, param, query, data, authenticated):
+        context = dict(name='Bench', isAuthenticated=authenticated, zipCode='2100')
+        self.reply(f'<script>var x = {{userContext: {json.dumps(context)}, y: 1}}</script>',
+                   content_type='text/html')
+
+    # The api
+
+    def get_api_store_get(self, param, query, data, authenticated):
+        self.reply([dict(id=1, address='Benchvej 1'), dict(id=2, address='Benchvej 2')])
+
+    def get_api_basket_get(self, param, query, data, authenticated):
+        with self.server.shop.lock:
+            self.reply(self.server.shop.basket_json())
+
+    def post_api_basket_update(self, param, query, data, authenticated):
+        shop = self.server.shop
+        with shop.lock:
+            updates = data['lineItemUpdates']
+            if any(not shop.products[u['productId']]['isInAssortment'] for u in updates):
+                return self.reply(dict(messages=[coop.UNAVAILABLE_MESSAGE], **shop.basket_json()))
+            for u in updates:
+                q = shop.basket.get(u['productId'], 0) + u['quantity']
+                if q > 0:
+                    shop.basket[u['productId']] = q
+                else:
+                    shop.basket.pop(u['productId'], None)
+            self.reply(shop.basket_json())
+
+    def post_api_stock_stock(self, param, query, data, authenticated):
+        stock = self.server.shop.stock
+        self.reply([dict(itemId=pid, quantity=stock.get(pid, 0),
+                         label='' if stock.get(pid) else 'Udsolgt',
+                         cutOffDate=None, cutOffExceeded=False, date=None)
+                    for pid in data['productIds']])
+
+    def get_api_search_search(self, param, query, data, authenticated):
+        term = param['term'].lower()
+        products = [p for p in self.server.shop.products.values()
+                    if p['isInAssortment'] and term in p['displayName'].lower()]
+        self.reply(dict(products=products[:int(param.get('pageSize', 10))]))
+
+    def get_api_search_getbyids(self, param, query, data, authenticated):
+        products = self.server.shop.products
+        self.reply(dict(products=[products[i] for i in query.get('productids', []) if i in products]))
+
+    def get_api_tophundred_get(self, param, query, data, authenticated):
+        products = list(self.server.shop.products.values())
+        self.reply(dict(products=products[:int(param.get('maxresults', 100))]))
+
+    def get_api_timeslot_gettimeslots(self, param, query, data, authenticated):
+        if 'selectedDate' in param:
+            start = datetime.date.fromisoformat(param['selectedDate'][:10])
+        else:
+            start = datetime.date.today()
+        days = []
+        for k in range(7):
+            date = start + datetime.timedelta(days=k)
+            slots = [dict(timeSlotId=f'{param["storeid"]}-{date}-{h}', displayName=f'{h}-{h + 1}',
+                          soldOut=(h + k) % 4 == 0, isSpecialSlot=False,
+                          deliveryDescription=f'{date} kl. {h}-{h + 1}',
+                          deliveryPrice=dict(amount=29 + (h >= 17) * 20))
+                     for h in range(8, 21)]
+            days.append(dict(deliveryDate=f'{date}T00:00:00',
+                             deliveryDateFormattedLong=date.strftime('%A %d. %B'),
+                             timeSlots=slots))
+        self.reply(dict(timeSlotDeliveryDays=days))
+
+    def post_api_timeslot_checkslot(self, param, query, data, authenticated):
+        self.reply(dict(totalPriceChange=None, unavailableProducts=None,
+                        changedProducts=None, isCheaper=None))
+
+    def post_api_timeslot_setdeliveryoptions(self, param, query, data, authenticated):
+        with self.server.shop.lock:
+            self.reply(dict(deliveryCheckoutMessage='', **self.server.shop.basket_json()))
+
+    def get_api_orderhistory_invoicedorders(self, param, query, data, authenticated):
+        page, size = int(param.get('page', 0)), int(param.get('pageSize', 100))
+        orders = sorted(self.server.shop.orders, key=lambda o: -o['orderNumber'])
+        self.reply(orders[page * size:(page + 1) * size])
+
+    def get_api_orderhistory_orderhistorydetail(self, param, query, data, authenticated):
+        shop = self.server.shop
+        # Some line items have a placeholder image, so the id isn't in the url
+        items = [dict(quantity=1 + i % 3, displayName=shop.products[pid]['displayName'],
+                      imageUrl=f'https://images.coop.dk/products/{pid}.png' if i % 4
+                      else 'https://images.coop.dk/placeholder.png')
+                 for i, pid in enumerate(shop.order_items[param['orderIdentifier']])]
+        self.reply(dict(categories=[dict(name='Kategori', lineItems=items)]))
+
+    def get_api_orderhistory_latesteditableorder(self, param, query, data, authenticated):
+        self.reply(self.server.shop.orders[-1])
+
+    def get_api_coopmember_get(self, param, query, data, authenticated):
+        self.reply({})
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, shop, latency=0.0, jitter=0.0, fail_rate=0.0):
+        super().__init__(('127.0.0.1', 0), MockHandler)
+        self.shop = shop
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.base = f'http://127.0.0.1:{self.server_port}/'
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def take_counts(self):
+        with self.lock:
+            counts, self.counts = self.counts, collections.Counter()
+        return counts
+
+
+def write_list(path, shop, n, seed=0):
+    """ A shopping list of n lines, each with two alternatives """
+    rnd = random.Random(seed)
+    pids = list(shop.products)
+    with open(path, 'w', newline='') as f:
+        f.write('# Benchmark liste\n')
+        for i in range(n):
+            first, *alternatives = rnd.sample(pids, 3)
+            name = shop.products[first]['displayName']
+            f.write(f'{rnd.randint(1, 3)},{name},{first} (første),{",".join(alternatives)}\n')
+
+
+def run_command(argv, coop_args=()):
+    """ Runs coop.py in-process with its output discarded. Returns an error or None. """
+    sys.argv = ['coop.py', '--username', 'bench', '--password', 'bench', *coop_args] + argv
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            coop.main()
+        except SystemExit as e:
+            if e.code:
+                return f'exit {e.code}'
+        except Exception as e:
+            return repr(e)
+    return None
+
+
+def run_scenario(server, coop_args, name, argv, setup=None, login_first=True):
+    shop = server.shop
+    result = dict(name=name, argv=argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            if login_first:
+                run_command(['bruger'], coop_args)
+            if setup:
+                setup(pathlib.Path(tmp))
+            for run in ('cold', 'warm'):
+                shop.basket.clear()
+                server.take_counts()
+                start = time.perf_counter()
+                error = run_command(argv, coop_args)
+                wall = time.perf_counter() - start
+                counts = server.take_counts()
+                result[run] = dict(wall_s=round(wall, 4), requests=sum(counts.values()),
+                                   by_endpoint=dict(counts.most_common()), error=error)
+        finally:
+            os.chdir(cwd)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--latency', type=float, default=20, help='Mean server latency in ms')
+    parser.add_argument('--jitter', type=float, default=5, help='Std. dev. of the latency in ms')
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help='Fraction of requests answered with 503')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Number of lines in the shopping lists')
+    parser.add_argument('--coop-args', default='',
+                        help='Extra global options for coop.py, e.g. "--rate 100"')
+    parser.add_argument('--out', type=argparse.FileType('w'), default=sys.stdout,
+                        help='Where to write the JSON results')
+    args = parser.parse_args()
+
+    shop = MockShop()
+    server = MockServer(shop, args.latency / 1000, args.jitter / 1000, args.fail_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    coop.SITE = server.base
+    coop.API = server.base + 'api/'
+    coop.LOGIN_URL = server.base + 'Account/Login'
+
+    scenarios = [('login', ['bruger'], None, False)]
+    for n in args.sizes:
+        scenarios.append((f'kurv --read {n}', ['kurv', '--read', f'list{n}.csv'],
+                          lambda tmp, n=n: write_list(tmp / f'list{n}.csv', shop, n, seed=n)))
+    scenarios += [
+        ('ordrer', ['ordrer'], None),
+        ('ordrer 0', ['ordrer', '0'], None),
+        ('tidspunkt --pick', ['tidspunkt', '--pick'], None),
+        ('ordrer --export', ['ordrer', '--export', 'ordrer'], None),
+    ]
+    coop_args = args.coop_args.split()
+    results = [run_scenario(server, coop_args, *scenario) for scenario in scenarios]
+    server.shutdown()
+
+    json.dump(dict(config=dict(latency_ms=args.latency, jitter_ms=args.jitter,
+                               fail_rate=args.fail_rate, coop_args=coop_args),
+                   results=results), args.out, indent=2)
+    args.out.write('\n')
+
+
+if __name__ == '__main__':
+    main()
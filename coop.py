@@ -1,9 +1,73 @@
+import json
+import os
+import socket
+import sys
+
+# Name of the socket a `coop.py daemon` listens on, next to cookies.coop
+SOCKET_NAME = 'cookies.sock'
+# Global options that configure the session. The daemon runs commands in its
+# own session and would ignore them, so commands using them run here.
+SESSION_OPTIONS = ['--debug', '--username', '--password', '--concurrency', '--no-cache',
+                   '--timeout', '--rate', '--profile', '--trace', '--stock-chunk-size']
+
+
+def option_given(argv, options):
+    """ Whether argv has one of options, also abbreviated like argparse allows """
+    for arg in argv:
+        if arg == '--':
+            break
+        name = arg.split('=', 1)[0]
+        if name.startswith('--') and len(name) > 2 and any(o.startswith(name) for o in options):
+            return True
+    return False
+
+
+def forward_to_daemon(argv):
+    """ Runs the command in the daemon listening in this directory, if there is one.
+    Returns the exit code, or None if no daemon is running or the command has
+    to run here. """
+    if not argv or 'daemon' in argv or not os.path.exists(SOCKET_NAME):
+        return None
+    # Watching runs until it is stopped. In the daemon it would block every other
+    # command, and stopping the client wouldn't stop it from booking a slot.
+    if option_given(argv, ['--watch']):
+        return None
+    if option_given(argv, SESSION_OPTIONS):
+        return None
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(SOCKET_NAME)
+    except OSError:
+        return None
+    with sock, sock.makefile('rw', encoding='utf-8') as f:
+        f.write(json.dumps(dict(argv=argv, cwd=os.getcwd())) + '\n')
+        f.flush()
+        for line in f:
+            message = json.loads(line)
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+                sys.stderr.flush()
+            else:
+                return message['exit']
+    return 1
+
+
+# Quick commands are mostly spent importing requests and setting up
+# a session, so hand them to a running daemon before doing any of that.
+if __name__ == '__main__':
+    exit_code = forward_to_daemon(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
 import requests
+import urllib3
+import asyncio
 import collections
 import pickle
-from lxml import html
-from urllib.parse import urlparse, parse_qs
-import json
+from urllib.parse import urlparse
 import pathlib
 import re
 import argparse
@@ -13,20 +77,650 @@ import logging
 import datetime
 import io
 import types
+import sqlite3
+import threading
+import time
+import zlib
+import random
+import email.utils
+import traceback
+import shlex
+import glob
+import concurrent.futures
+import contextvars
+import array
+import math
+import login
+import models
+from models import product_price
+
+SITE = 'https://butik.mad.coop.dk/'
+API = SITE + 'api/'
+LOGIN_URL = 'https://accounts.cl.coop.dk/Account/Login'
+
+# Seconds before the stored user context is refetched to get a current zip code
+CONTEXT_MAX_AGE = 7 * 24 * 3600
+
+# Seconds before a name that couldn't be resolved to a product id is searched again
+LOOKUP_RETRY_AGE = 7 * 24 * 3600
+
+# POST endpoints that only read, so they can safely be sent again on errors
+IDEMPOTENT_POSTS = {'stock/stock', 'timeslot/checkslot'}
+
+WEEKDAYS = ['mandag', 'tirsdag', 'onsdag', 'torsdag', 'fredag', 'lørdag', 'søndag']
+
+# Message from basket/update when some of the products have been delisted
+UNAVAILABLE_MESSAGE = 'Et eller flere produkter er ikke længere tilgængelige'
+
+# Seconds a cached response stays fresh for each endpoint. None means forever.
+CACHE_TTL = {
+    'store/get': 3 * 24 * 3600,
+    'search/search': 6 * 3600,
+    'search/getbyids': 6 * 3600,
+    'tophundred/get': 6 * 3600,
+    'orderhistory/invoicedorders': 15 * 60,
+    # Invoiced orders don't change. Editable ones are fetched without the cache.
+    'orderhistory/orderhistorydetail': None,
+    'stock/stock': 30,
+    'timeslot/gettimeslots': 60,
+}
+
+# Endpoints changing the basket, and the cached endpoints they make stale.
+CACHE_INVALIDATES = {
+    'basket/update': ['stock/stock'],
+    'timeslot/SetDeliveryOptions': ['stock/stock', 'timeslot/gettimeslots'],
+    'editorder/initEdit': ['stock/stock', 'orderhistory/invoicedorders'],
+    'editorder/cancelEditOrderMode': ['stock/stock'],
+}
+
+
+class CoopError(Exception):
+    """ Coop couldn't be reached or kept failing a request """
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """ Holds an exclusive lock on the file at path, shared with other processes """
+    with open(path, 'a') as f:
+        try:
+            import fcntl
+        except ImportError:
+            # Windows
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK only waits about 10 seconds
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+
+class RateLimiter:
+    """ Token bucket allowing `rate` requests per second on average,
+    in bursts of up to `burst` requests. Shared by all threads. """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # The token may be borrowed from the future, in which case we wait for it
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def retry_delay(attempt, r=None, base=0.5, cap=30):
+    """ Seconds to wait before retrying: the server's Retry-After if it sent one,
+    otherwise exponential backoff with full jitter. """
+    retry_after = r.headers.get('Retry-After') if r is not None else None
+    if retry_after:
+        if retry_after.isdigit():
+            return min(cap, int(retry_after))
+        with contextlib.suppress(TypeError, ValueError):
+            when = email.utils.parsedate_to_datetime(retry_after)
+            return min(cap, max(0, when.timestamp() - time.time()))
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Profiler:
+    """ Records the requests sent and the time spent in local phases.
+    Can print a summary per endpoint and write a Chrome trace (chrome://tracing). """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.requests = []  # (endpoint, status, bytes, ttfb, transfer)
+        self.durations = collections.defaultdict(list)  # Seconds per name
+        self.events = []
+
+    def _event(self, name, category, start, end, **args):
+        self.events.append(dict(
+            name=name, cat=category, ph='X', pid=os.getpid(), tid=threading.get_ident(),
+            ts=(start - self.start) * 1e6, dur=(end - start) * 1e6, args=args))
+
+    def record_request(self, endpoint, r, start, end):
+        """ Time to the headers includes connecting, if a new connection was needed """
+        ttfb = min(r.elapsed.total_seconds(), end - start)
+        with self.lock:
+            self.requests.append((endpoint, r.status_code, len(r.content), ttfb, end - start - ttfb))
+            self.durations[endpoint].append(end - start)
+            self._event(endpoint, 'request', start, end, status=r.status_code,
+                        bytes=len(r.content), ttfb_ms=ttfb * 1e3)
+
+    def record(self, name, category, start, end):
+        with self.lock:
+            self.durations[name].append(end - start)
+            self._event(name, category, start, end)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, 'phase', start, time.perf_counter())
+
+    def print_summary(self, file=sys.stderr):
+        print(f'{"":40} {"antal":>6} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8}', file=file)
+        for name, times in sorted(self.durations.items(), key=lambda kv: -sum(kv[1])):
+            times = sorted(times)
+            p50, p95 = (times[min(len(times) - 1, int(q * len(times)))] for q in (.5, .95))
+            print(f'{name[:40]:40} {len(times):6} {p50 * 1e3:8.1f} {p95 * 1e3:8.1f} '
+                  f'{times[-1] * 1e3:8.1f}', file=file)
+        if self.requests:
+            size = sum(r[2] for r in self.requests)
+            ttfb = sum(r[3] for r in self.requests)
+            transfer = sum(r[4] for r in self.requests)
+            print(f'{len(self.requests)} requests, {size / 1024:.0f} kB, '
+                  f'{ttfb:.2f}s til headers, {transfer:.2f}s overførsel', file=file)
+
+    def write_trace(self, file):
+        json.dump(dict(traceEvents=self.events, displayTimeUnit='ms'), file)
+
+
+class ResponseCache:
+    """ Response texts stored in SQLite, keyed by endpoint and parameters.
+    When the texts take up more than max_bytes, the least recently used are evicted. """
+
+    def __init__(self, path, max_bytes=50 * 2**20):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, endpoint TEXT, created REAL, used REAL,
+            size INTEGER, text TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_endpoint ON responses (endpoint)')
+
+    def get(self, endpoint, key, ttl):
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT created, text FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            created, text = row
+            if ttl is not None and created + ttl < time.time():
+                return None
+            self.db.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+            return text
+
+    def put(self, endpoint, key, text):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, endpoint, now, now, len(text), text))
+            self.db.execute('''DELETE FROM responses WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY used DESC) AS total
+                    FROM responses)
+                WHERE total > ?)''', (self.max_bytes,))
+
+    def invalidate(self, endpoints):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM responses WHERE endpoint = ?',
+                                [(e,) for e in endpoints])
+
+    def close(self):
+        self.db.close()
+
+
+class Catalog:
+    """ Local index of every product seen in responses from Coop.
+    Names are searchable offline using SQLite FTS5, including products that
+    are no longer in the assortment. Also remembers the ids that names from the
+    order history were looked up as. """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS products (
+                id TEXT PRIMARY KEY, displayName TEXT, category TEXT, spotText TEXT,
+                labels TEXT, price REAL, isInAssortment INTEGER, url TEXT);
+            CREATE VIRTUAL TABLE IF NOT EXISTS product_index USING fts5(
+                displayName, category, spotText, labels,
+                content=products, content_rowid=rowid);
+            CREATE TRIGGER IF NOT EXISTS products_insert AFTER INSERT ON products BEGIN
+                INSERT INTO product_index (rowid, displayName, category, spotText, labels)
+                VALUES (new.rowid, new.displayName, new.category, new.spotText, new.labels);
+            END;
+            CREATE TRIGGER IF NOT EXISTS products_update AFTER UPDATE ON products BEGIN
+                INSERT INTO product_index (product_index, rowid, displayName, category, spotText, labels)
+                VALUES ('delete', old.rowid, old.displayName, old.category, old.spotText, old.labels);
+                INSERT INTO product_index (rowid, displayName, category, spotText, labels)
+                VALUES (new.rowid, new.displayName, new.category, new.spotText, new.labels);
+            END;
+            CREATE TABLE IF NOT EXISTS lookups (name TEXT PRIMARY KEY, id TEXT, time REAL);''')
+
+    def add(self, products):
+        """ Adds or updates products. Missing fields don't overwrite known ones. """
+        rows = []
+        for p in products:
+            if not p.get('id'):
+                continue
+            labels = p.get('labels')
+            if labels is not None:
+                labels = json.dumps(labels, ensure_ascii=False)
+            in_assortment = p.get('isInAssortment')
+            rows.append((p['id'], p.get('displayName'), p.get('category'), p.get('spotText'),
+                         labels, product_price(p),
+                         None if in_assortment is None else int(in_assortment), p.get('url')))
+        with self.lock, self.db:
+            self.db.executemany('''
+                INSERT INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    displayName = coalesce(excluded.displayName, displayName),
+                    category = coalesce(excluded.category, category),
+                    spotText = coalesce(excluded.spotText, spotText),
+                    labels = coalesce(excluded.labels, labels),
+                    price = coalesce(excluded.price, price),
+                    isInAssortment = coalesce(excluded.isInAssortment, isInAssortment),
+                    url = coalesce(excluded.url, url)''', rows)
+
+    def names(self, pids):
+        """ Dict from id to display name for the known products among pids """
+        pids = list(pids)
+        names = {}
+        with self.lock:
+            for i in range(0, len(pids), 500):
+                chunk = pids[i:i + 500]
+                names.update(self.db.execute(
+                    f'SELECT id, displayName FROM products WHERE id IN '
+                    f'({",".join("?" * len(chunk))})', chunk))
+        return names
+
+    def name_ids(self, names):
+        """ Dict from name to id for the names among names that are the display
+        name of a known product. Products in the assortment win. """
+        names = list(names)
+        ids = {}
+        with self.lock:
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                for name, pid in self.db.execute(
+                        f'SELECT displayName, id FROM products WHERE displayName IN '
+                        f'({",".join("?" * len(chunk))}) '
+                        f'ORDER BY coalesce(isInAssortment, 1) DESC', chunk):
+                    ids.setdefault(name, pid)
+        return ids
+
+    def lookups(self, names, max_miss_age=LOOKUP_RETRY_AGE):
+        """ Dict from name to the id found when the name was looked up before.
+        Names that weren't found map to None, unless that was more than
+        max_miss_age seconds ago. """
+        names = list(names)
+        found = {}
+        with self.lock:
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                for name, pid, t in self.db.execute(
+                        f'SELECT name, id, time FROM lookups WHERE name IN '
+                        f'({",".join("?" * len(chunk))})', chunk):
+                    if pid is not None or time.time() - t < max_miss_age:
+                        found[name] = pid
+        return found
+
+    def add_lookups(self, found):
+        """ Remembers the ids found for names. found is a dict from name to id,
+        or None if the name wasn't found. """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)',
+                                [(name, pid, now) for name, pid in found.items()])
+
+    def delisted(self, pids):
+        """ The ids among pids of products known to be out of the assortment """
+        pids = list(pids)
+        found = set()
+        with self.lock:
+            for i in range(0, len(pids), 500):
+                chunk = pids[i:i + 500]
+                found.update(pid for pid, in self.db.execute(
+                    f'SELECT id FROM products WHERE isInAssortment = 0 AND id IN '
+                    f'({",".join("?" * len(chunk))})', chunk))
+        return found
+
+    def search(self, term, n=10):
+        """ Products whose words start with the words of the term, in the same
+        format as the products from Coop.search. Products in the assortment come first. """
+        words = re.findall(r'\w+', term)
+        if not words:
+            return []
+        query = ' '.join(f'"{w}"*' for w in words)
+        with self.lock:
+            rows = self.db.execute('''
+                SELECT p.id, p.displayName, p.category, p.spotText, p.labels, p.price,
+                       p.isInAssortment, p.url
+                FROM product_index JOIN products p ON p.rowid = product_index.rowid
+                WHERE product_index MATCH ?
+                ORDER BY coalesce(p.isInAssortment, 1) DESC, rank
+                LIMIT ?''', (query, n)).fetchall()
+        return [models.Product(id=pid, displayName=name, category=category,
+                               spotText=spot_text or '', labels=json.loads(labels or '[]'),
+                               price=price,
+                               isInAssortment=None if in_assortment is None
+                               else bool(in_assortment),
+                               url=url)
+                for pid, name, category, spot_text, labels, price, in_assortment, url in rows]
+
+    def close(self):
+        self.db.close()
+
+
+class OrderStore:
+    """ Local copy of the order history. Orders and their details are stored as
+    compressed JSON in SQLite. """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS orders (
+            orderIdentifier TEXT PRIMARY KEY, orderNumber INTEGER,
+            summary BLOB, detail BLOB)''')
+
+    @staticmethod
+    def _pack(obj):
+        return zlib.compress(models.dumps(obj))
+
+    @staticmethod
+    def _unpack(blob, model=None):
+        if blob is None:
+            return None
+        data = zlib.decompress(blob)
+        return models.loads(data) if model is None else models.decode(data, model)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+
+    def __contains__(self, order_identifier):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM orders WHERE orderIdentifier = ?',
+                                   (order_identifier,)).fetchone() is not None
+
+    def add_orders(self, orders):
+        with self.lock, self.db:
+            self.db.executemany('''
+                INSERT INTO orders VALUES (?, ?, ?, NULL)
+                ON CONFLICT (orderIdentifier) DO UPDATE SET summary = excluded.summary''',
+                [(o['orderIdentifier'], o['orderNumber'], self._pack(o)) for o in orders])
+
+    def add_details(self, details):
+        """ details is an iterable of (orderIdentifier, detail) pairs """
+        with self.lock, self.db:
+            self.db.executemany('UPDATE orders SET detail = ? WHERE orderIdentifier = ?',
+                                [(self._pack(d), i) for i, d in details])
+
+    def missing_details(self):
+        """ Identifiers of orders without details. Editable orders may still
+        change, so their details are never stored. """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT orderIdentifier, summary FROM orders WHERE detail IS NULL').fetchall()
+        return [i for i, summary in rows if not self._unpack(summary).get('isEditable')]
+
+    def editable(self):
+        """ Identifiers of the orders that were editable when last synced """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT orderIdentifier, summary FROM orders WHERE detail IS NULL').fetchall()
+        return [i for i, summary in rows if self._unpack(summary).get('isEditable')]
+
+    def orders(self):
+        """ All stored orders, newest first """
+        return list(self.iter_orders())
+
+    def iter_orders(self, page_size=100):
+        """ Like orders, but reads them a page at a time """
+        last = math.inf
+        while True:
+            with self.lock:
+                rows = self.db.execute('''SELECT orderNumber, summary FROM orders
+                                          WHERE orderNumber < ? ORDER BY orderNumber DESC
+                                          LIMIT ?''', (last, page_size)).fetchall()
+            for last, summary in rows:
+                yield self._unpack(summary, models.Order)
+            if len(rows) < page_size:
+                return
+
+    def detail(self, order_identifier):
+        with self.lock:
+            row = self.db.execute('SELECT detail FROM orders WHERE orderIdentifier = ?',
+                                  (order_identifier,)).fetchone()
+        return None if row is None else self._unpack(row[0], models.OrderDetail)
+
+    def details(self):
+        """ The details of every stored order, oldest first """
+        with self.lock:
+            rows = self.db.execute('''SELECT detail FROM orders WHERE detail IS NOT NULL
+                                      ORDER BY orderNumber''').fetchall()
+        return [self._unpack(detail, models.OrderDetail) for detail, in rows]
+
+    def close(self):
+        self.db.close()
+
+
+class PriceHistory:
+    """ Every price and stock quantity seen, stored column-wise in flat binary files
+    in a directory. Appending only needs the standard library, while load() maps the
+    columns into NumPy arrays for fast queries over millions of observations. """
+    # Column name -> array typecode
+    COLUMNS = {'time': 'd', 'product': 'q', 'price': 'f', 'quantity': 'i', 'slot': 'i'}
+
+    def __init__(self, path):
+        self.path = path
+        self.path.mkdir(exist_ok=True)
+        self.lock = threading.Lock()
+        self.slots_path = path / 'slots.json'
+
+    def _append(self, rows):
+        """ rows are (time, product, price, quantity, slot). A missing price is NaN,
+        and a missing quantity or slot is -1. """
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        # Other processes may append at the same time
+        with self.lock, file_lock(self.path / 'lock'):
+            for (name, typecode), values in zip(self.COLUMNS.items(), columns):
+                with open(self.path / name, 'ab') as f:
+                    array.array(typecode, values).tofile(f)
+
+    def slots(self):
+        """ List of [timeSlotId, description] where the index is the slot column """
+        if self.slots_path.is_file():
+            return json.loads(self.slots_path.read_text())
+        return []
+
+    def slot_index(self, timeslot_id, description=None):
+        # Other processes may add slots at the same time
+        with self.lock, file_lock(self.path / 'lock'):
+            slots = self.slots()
+            for i, (slot_id, known) in enumerate(slots):
+                if slot_id == timeslot_id:
+                    if description and description != known:
+                        slots[i][1] = description
+                        self._write_slots(slots)
+                    return i
+            slots.append([timeslot_id, description])
+            self._write_slots(slots)
+            return len(slots) - 1
+
+    def _write_slots(self, slots):
+        # Replaced in one go, so readers never see it half written
+        tmp = self.slots_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(slots, ensure_ascii=False))
+        os.replace(tmp, self.slots_path)
+
+    def add_products(self, products):
+        now = time.time()
+        rows = []
+        for p in products:
+            price = product_price(p)
+            if price is not None and str(p.get('id', '')).isdigit():
+                rows.append((now, int(p['id']), price, -1, -1))
+        self._append(rows)
+
+    def add_stock(self, stock, timeslot_id):
+        now = time.time()
+        slot = self.slot_index(timeslot_id)
+        self._append([(now, int(s['itemId']), math.nan, s['quantity'], slot)
+                      for s in stock if str(s['itemId']).isdigit()])
+
+    def load(self):
+        """ The columns as a dict of read-only NumPy arrays of equal length """
+        import numpy as np
+        columns = {}
+        for name, typecode in self.COLUMNS.items():
+            path = self.path / name
+            dtype = np.dtype(typecode)
+            if path.is_file() and path.stat().st_size >= dtype.itemsize:
+                columns[name] = np.memmap(path, dtype=dtype, mode='r')
+            else:
+                columns[name] = np.zeros(0, dtype=dtype)
+        # A crash while appending can leave some columns longer than others
+        n = min(len(column) for column in columns.values())
+        return {name: column[:n] for name, column in columns.items()}
+
+
+def cookie_values(jar):
+    """ {(domain, path, name): value} for the cookies in jar """
+    return {(c.domain, c.path, c.name): c.value for c in jar}
+
+
+def stored_credentials(cookies_path, username=None):
+    """ Looks up (username, password) in the environment variables COOP_USERNAME
+    and COOP_PASSWORD, then in a json file next to the cookies, and at last in the
+    system keyring under the service "coop.py". Returns None if nothing is found. """
+    username = username or os.environ.get('COOP_USERNAME')
+    password = os.environ.get('COOP_PASSWORD')
+    path = cookies_path.with_suffix('.credentials')
+    if not password and path.is_file():
+        stored = json.loads(path.read_text())
+        if username in (None, stored['username']):
+            username, password = stored['username'], stored['password']
+    if not password and username:
+        try:
+            import keyring
+        except ImportError:
+            pass
+        else:
+            password = keyring.get_password('coop.py', username)
+    return (username, password) if username and password else None
+
+
+def line_item_pid(item):
+    """ The product id of a line item from the order history, or None """
+    # TODO: This image url thing is a hack :(
+    pid = re.search(r'products/(\d+?).png', str(item['imageUrl']))
+    return pid.group(1) if pid else None
+
+
+def products_of(res):
+    """ Product lists come both bare and wrapped in models.ProductList """
+    return res if isinstance(res, list) else res['products']
 
-API = 'https://butik.mad.coop.dk/api/'
+
+class CachedResponse:
+    """ Stands in for a requests.Response when the text came from the cache """
+    status_code = 200
+
+    def __init__(self, text, endpoint):
+        self.text = text
+        self.endpoint = endpoint + ' (cache)'
+
+    @property
+    def content(self):
+        return self.text.encode()
+
+
+def endpoint_name(path):
+    """ The part of an url after the API root, or the path for other pages """
+    if path.startswith(API):
+        return path[len(API):]
+    return urlparse(path).path
 
 
 class Coop:
-    def __init__(self, cookies_path):
+    def __init__(self, cookies_path, concurrency=8, use_cache=True, stock_chunk_size=100,
+                 timeout=30, rate=10, retries=3, profiler=None):
         self.cookies_path = cookies_path
+        self.profiler = profiler
+        self.concurrency = concurrency
+        self.stock_chunk_size = stock_chunk_size
+        # (connect, read) timeouts in seconds for every request
+        self.timeout = (5, timeout)
+        self.retries = retries
+        self.rate_limiter = RateLimiter(rate, burst=concurrency)
+        self.cache = None
+        if use_cache:
+            self.cache = ResponseCache(cookies_path.with_suffix('.cache'))
+        self.catalog = Catalog(cookies_path.with_suffix('.catalog'))
+        self.order_store = OrderStore(cookies_path.with_suffix('.orders'))
+        self.history = PriceHistory(cookies_path.with_suffix('.history'))
         self.s = requests.Session()
-        if cookies_path.is_file():
-            with cookies_path.open('rb') as f:
-                self.s.cookies.update(pickle.load(f))
-
-        self.context = self.get_user_context()
-        self.zip = self.context['zipCode']
+        # Keep a live connection per concurrent request, see AsyncCoop.
+        # Connection errors are retried here: failing to connect for all requests,
+        # since nothing has been sent yet, and broken responses only for GET.
+        # Error statuses are retried by _request.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=concurrency, pool_block=True,
+            max_retries=urllib3.Retry(total=None, connect=retries, read=retries, status=0,
+                                      other=0, backoff_factor=0.5))
+        self.s.mount('https://', adapter)
+        self.s.mount('http://', adapter)
+        self.s.cookies.update(self._load_cookies())
+        # The cookies as they were on disk, so save_cookies only writes what changed
+        self._saved_cookies = cookie_values(self.s.cookies)
+        # (username, password) used to log in again when the session expires
+        self.credentials = None
+        # Number of successful logins, see relogin
+        self.logins = 0
+        self.login_lock = threading.Lock()
+        self.login_flow = login.LoginFlow(self._request, API + 'authentication/loginsrc',
+                                          LOGIN_URL, self.phase)
+
+        # The user context is stored next to the cookies and only fetched when needed
+        self.context_path = cookies_path.with_suffix('.context')
+        self._context = None
+        self._context_time = 0
 
     def __enter__(self):
         return self
@@ -35,74 +729,212 @@ class Coop:
         self.close()
 
     def close(self):
-        with self.cookies_path.open('wb') as f:
-            pickle.dump(self.s.cookies, f)
-
-    def __login(self, url, username, password):
-        r = self.s.get(url)
-        tree = html.fromstring(r.text)
-        veri_token = tree.xpath('/html/body/div/div[1]/form/input/@value')[0]
-        action = tree.xpath('/html/body/div/div[1]/form/@action')[0]
-        params = parse_qs(urlparse(action).query)
-        r = self.s.post('https://accounts.cl.coop.dk/Account/Login',
-                        params=params,
-                        data={
-                            '__RequestVerificationToken': veri_token,
-                            'UserName': username,
-                            'Password': password,
-                        })
-        return self.__login_cb(r)
+        self.save_cookies()
+        if self.cache is not None:
+            self.cache.close()
+        self.catalog.close()
+        self.order_store.close()
+
+    @contextlib.contextmanager
+    def _cookies_locked(self):
+        """ Holds a lock on the cookie jar, which other processes may share """
+        with file_lock(self.cookies_path.with_suffix('.lock')):
+            yield
+
+    def _load_cookies(self):
+        if not self.cookies_path.is_file():
+            return requests.cookies.RequestsCookieJar()
+        with self.cookies_path.open('rb') as f:
+            return pickle.load(f)
+
+    def save_cookies(self):
+        """ Writes the cookies that changed or were deleted in this session into
+        the jar on disk. Cookies other processes have written in the meantime are
+        kept, and the jar is replaced atomically, so it is never seen half written. """
+        with self._cookies_locked():
+            jar = self._load_cookies()
+            current = cookie_values(self.s.cookies)
+            for cookie in self.s.cookies:
+                key = (cookie.domain, cookie.path, cookie.name)
+                if self._saved_cookies.get(key) != cookie.value:
+                    jar.set_cookie(cookie)
+            # The server deleted these, e.g. with an expiry in the past
+            for key in self._saved_cookies.keys() - current.keys():
+                with contextlib.suppress(KeyError):
+                    jar.clear(*key)
+            tmp = self.cookies_path.with_name(f'{self.cookies_path.name}.{os.getpid()}.tmp')
+            with tmp.open('wb') as f:
+                pickle.dump(jar, f)
+            os.replace(tmp, self.cookies_path)
+            self._saved_cookies = current
+
+    @property
+    def context(self):
+        if self._context is None:
+            if self.context_path.is_file():
+                stored = json.loads(self.context_path.read_text())
+                self._context, self._context_time = stored['context'], stored['time']
+            else:
+                self.refresh_context()
+        return self._context
+
+    @property
+    def zip(self):
+        context = self.context
+        if time.time() - self._context_time > CONTEXT_MAX_AGE:
+            context = self.refresh_context()
+        return context['zipCode']
+
+    def refresh_context(self):
+        self._context = self.get_user_context()
+        self._context_time = time.time()
+        self.context_path.write_text(json.dumps(
+            {'time': self._context_time, 'context': self._context}))
+        return self._context
+
+    def forget_context(self):
+        """ Makes the next use of the context fetch it again """
+        self._context = None
+        self._context_time = 0
+        self.context_path.unlink(missing_ok=True)
+
+    def phase(self, name):
+        """ Context manager timing a local phase when profiling """
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.phase(name)
 
     def login(self, username, password, skip_context=False):
-        success = self.__login(API + 'authentication/loginsrc', username, password)
+        try:
+            success = self.login_flow.login(username, password)
+        except login.LoginError as e:
+            raise CoopError(f'Kunne ikke logge ind: {e}') from e
         if success:
-            # Update context to make sure zip is correct
-            self.context = self.get_user_context()
-            self.zip = self.context['zipCode']
+            self.credentials = (username, password)
+            self.logins += 1
+            if not skip_context:
+                # Update context to make sure zip is correct
+                self.refresh_context()
         return success
 
-    def __login_cb(self, r):
-        if 'Adgangskoden er forkert' in r.text:
-            return False
-        tree = html.fromstring(r.text)
-        names = tree.xpath('/html/body/form/input/@name')
-        values = tree.xpath('/html/body/form/input/@value')
-        data = dict(zip(names, values))
-        action = html.fromstring(r.text).xpath('/html/body/form/@action')[0]
-        # This call just returns a page asking us to go back
-        # 'window.parent.location.href = window.parent.location.href;'
-        self.s.post(action, data=data)
-        return True
-
-    def get(self, path, **kwargs):
-        """ Keyword arguments are sent as params """
-        r = self.s.get(path, params=kwargs)
+    def relogin(self, logins):
+        """ Logs in again with the stored credentials after the session has expired.
+        logins is self.logins from before the failed request: if another thread has
+        logged in since then, there is no need to do it again. """
+        with self.login_lock:
+            if self.logins != logins:
+                return
+            # The stored context still says we are logged in. Forget it, so the
+            # next run checks again and asks for a login if it has to.
+            self.forget_context()
+            if self.credentials is None:
+                raise CoopError('Ikke længere logget ind, og der er ingen gemte '
+                                'login-oplysninger. Kør coop.py igen for at logge ind.')
+            print('Logger ind igen...')
+            if not self.login(*self.credentials, skip_context=True):
+                raise CoopError('Kunne ikke logge ind igen. Forkert username eller password.')
+            self.save_cookies()
+
+    def _cache_lookup(self, path, params):
+        """ Returns (endpoint, key, cached text) for a request to path """
+        endpoint = endpoint_name(path)
+        key = f'{endpoint}?{json.dumps(params, sort_keys=True, default=str)}'
+        if self.cache is None or endpoint not in CACHE_TTL:
+            return endpoint, key, None
+        return endpoint, key, self.cache.get(endpoint, key, CACHE_TTL[endpoint])
+
+    def _cache_store(self, endpoint, key, r):
+        if self.cache is None:
+            return
+        if endpoint in CACHE_INVALIDATES:
+            self.cache.invalidate(CACHE_INVALIDATES[endpoint])
+        if endpoint in CACHE_TTL and r.status_code == 200:
+            self.cache.put(endpoint, key, r.text)
+
+    def _request(self, method, path, retry=True, **kwargs):
+        """ Sends a request with the rate limit and timeouts applied. If retry is set,
+        server errors are retried with backoff. Otherwise only the responses saying
+        the request wasn't handled (429 and 503) are. """
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                r = self.s.request(method, path, timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                raise CoopError(f'Kunne ikke kontakte Coop: {e}') from e
+            if self.profiler is not None:
+                self.profiler.record_request(endpoint_name(path), r, start, time.perf_counter())
+            unhandled = r.status_code in (429, 503)
+            if attempt == self.retries or not (unhandled or retry and r.status_code >= 500):
+                return r
+            delay = retry_delay(attempt, r)
+            logging.debug('Retrying %s %s in %.1fs', method, path, delay)
+            time.sleep(delay)
+
+    def _send(self, method, path, **kwargs):
+        """ Like _request, but if the session has expired, logs in again and
+        replays the request once """
+        logins = self.logins
+        r = self._request(method, path, **kwargs)
+        if 'Authorization has been denied for this request' in r.text:
+            self.relogin(logins)
+            r = self._request(method, path, **kwargs)
+            if 'Authorization has been denied for this request' in r.text:
+                self.forget_context()
+                raise CoopError('Coop afviser stadig forespørgslen efter nyt login.')
+        return r
+
+    def get(self, path, cached=True, store=True, **kwargs):
+        """ Keyword arguments are sent as params. If cached is false, the response
+        is fetched even if the cache has a fresh copy. If store is false, the
+        response isn't cached. """
+        endpoint, key, text = self._cache_lookup(path, kwargs)
+        if text is not None and cached:
+            return CachedResponse(text, endpoint)
+        r = self._send('GET', path, params=kwargs)
+        r.endpoint = endpoint
         if '<noscript><button>Click to continue</button>' in r.text:
             # if "action='https://coop.dk/login/login/logincallback'" in r.text:
             print('Using login_callback')
-            return self.__login_cb(r)
-        if 'Authorization has been denied for this request' in r.text:
-            print('No longer logged in. Please remove cookies and try again')
-            # TODO: We could do this
-            return r
+            return self.login_flow.callback_page(r.text)
+        if r.status_code >= 500:
+            raise CoopError(f'Coop svarede {r.status_code} på {endpoint}. Prøv igen senere.')
         if r.status_code != 200:
             print('Status code:', r)
             print('Text:', r.text)
-        if r.status_code == 500:
-            print('Try again later.')
+        if store:
+            self._cache_store(endpoint, key, r)
         return r
 
     def post(self, path, **kwargs):
         """ Keyword arguments are sent as json """
-        r = self.s.post(path, json=kwargs)
+        endpoint, key, text = self._cache_lookup(path, kwargs)
+        if text is not None:
+            return CachedResponse(text, endpoint)
+        # A request that was denied was not carried out, so it is safe to replay
+        r = self._send('POST', path, retry=endpoint in IDEMPOTENT_POSTS, json=kwargs)
+        r.endpoint = endpoint
+        if r.status_code >= 500:
+            raise CoopError(f'Coop svarede {r.status_code} på {endpoint}. Prøv igen senere.')
         if r.status_code != 200:
             print('Status code:', r)
             print('Text:', r.text)
+        self._cache_store(endpoint, key, r)
         return r
 
+    def _json(self, r, model=None):
+        """ Decodes a response from get or post, into model if it is given.
+        model can also be a typing expression like list[models.Order]. """
+        if self.profiler is None:
+            return models.loads(r.content) if model is None else models.decode(r.content, model)
+        start = time.perf_counter()
+        res = models.loads(r.content) if model is None else models.decode(r.content, model)
+        self.profiler.record(f'json {r.endpoint}', 'json', start, time.perf_counter())
+        return res
+
     def get_latest_editable_order(self):
-        r = coop.get(API + 'orderhistory/latesteditableorder')
-        return json.loads(r.text)
+        r = self.get(API + 'orderhistory/latesteditableorder')
+        return self._json(r, models.Order)
 
     @contextlib.contextmanager
     def edit_order(self, order_identifier):
@@ -116,22 +948,22 @@ class Coop:
 
     def get_stores(self, is_new_site=True):
         r = self.get(API + 'store/get', isNewSite=is_new_site, zipCode=self.zip)
-        return json.loads(r.text)
+        return self._json(r)
 
-    def get_timeslots(self, is_home_delivery, store_id, date=None):
+    def get_timeslots(self, is_home_delivery, store_id, date=None, cached=True):
         params = dict(isHomeDelivery=is_home_delivery,
                       storeid=store_id,
                       zipCode=self.zip)
         if date:
             params['selectedDate'] = f'{date.isoformat()}T00:00:00'
-        r = self.get(API + 'timeslot/gettimeslots', **params)
-        return json.loads(r.text)
+        r = self.get(API + 'timeslot/gettimeslots', cached=cached, **params)
+        return self._json(r, models.TimeSlots)
 
     def check_slot(self, time_slot_id, store_id):
         r = self.post(API + 'timeslot/checkslot',
                       id=time_slot_id, storeid=store_id, zipCode=self.zip)
         # Success: {"totalPriceChange":null,"unavailableProducts":null,"changedProducts":null,"isCheaper":null}
-        return json.loads(r.text)
+        return self._json(r)
 
     def set_delivery_options(self, time_slot_id, store_id,
                              is_home_delivery, umbraco=1064):
@@ -141,21 +973,67 @@ class Coop:
                       timeSlotId=time_slot_id, storeId=store_id, zipCode=self.zip,
                       isHomeDelivery=True, umbracoPageId=umbraco)
         # Same type of response as update_basked requests.
-        return json.loads(r.text)
-
-    def get_invoiced_orders(self, n=100, page=0):
-        r = self.get(API + 'orderhistory/invoicedorders', page=page, pageSize=n)
-        return json.loads(r.text)
-
-    def get_order_history_detail(self, order_identifier):
+        return self._json(r, models.Basket)
+
+    def get_invoiced_orders(self, n=100, page=0, cached=True):
+        r = self.get(API + 'orderhistory/invoicedorders', cached=cached, page=page, pageSize=n)
+        return self._json(r, list[models.Order])
+
+    def iter_invoiced_orders(self, page_size=20, cached=True):
+        """ All invoiced orders, fetched one page at a time """
+        page = 0
+        while True:
+            orders = self.get_invoiced_orders(n=page_size, page=page, cached=cached)
+            yield from orders
+            if len(orders) < page_size:
+                return
+            page += 1
+
+    def sync_orders(self, page_size=20):
+        """ Adds new orders to the order store, and fetches the missing details
+        concurrently. Pages are fetched until one has no new orders and every
+        stored order that was editable has been seen again, so its summary is
+        refreshed. Returns the number of new orders. """
+        editable = set(self.order_store.editable())
+        new = 0
+        page = 0
+        while True:
+            # A cached page would hide new orders and stale isEditable flags
+            orders = self.get_invoiced_orders(n=page_size, page=page, cached=False)
+            # The pages aren't necessarily sorted, so a page is only known to be
+            # old when none of its orders are new
+            fresh = [o for o in orders if o['orderIdentifier'] not in self.order_store]
+            new += len(fresh)
+            editable.difference_update(o['orderIdentifier'] for o in orders)
+            self.order_store.add_orders(orders)
+            if len(orders) < page_size or not fresh and not editable:
+                break
+            page += 1
+        missing = self.order_store.missing_details()
+        details = fan_out(self, 'get_order_history_detail', [(i,) for i in missing])
+        self.order_store.add_details(zip(missing, details))
+        return new
+
+    def get_order_history_detail(self, order_identifier, editable=False):
+        # Editable orders may still change, so their details are never cached
         r = self.get(
             API + 'orderhistory/orderhistorydetail',
+            cached=not editable, store=not editable,
             orderIdentifier=order_identifier)
-        return json.loads(r.text)
+        details = self._json(r, models.OrderDetail)
+        self.catalog.add(
+            dict(id=line_item_pid(item), displayName=item['displayName'], category=cat['name'])
+            for cat in details['categories'] for item in cat['lineItems'])
+        return details
 
     def get_basket(self, refresh=False):
         r = self.get(API + 'basket/get', refresh=refresh)
-        return json.loads(r.text)
+        basket = self._json(r, models.Basket)
+        self.history.add_products(item['product'] for item in basket['lineItems'])
+        if basket['timeSlot'] is not None:
+            self.history.slot_index(basket['timeSlot']['timeSlotId'],
+                                    basket['timeSlot']['deliveryDescription'])
+        return basket
 
     def multi_update_basket(self, id_qs):
         r = self.post(
@@ -166,13 +1044,54 @@ class Coop:
                     quantity=q,
                     lineItemId=None) for pi,
                 q in id_qs])
-        return json.loads(r.text)
+        return self._json(r, models.Basket)
 
     def update_basket(self, product_id, quantity, line_item_id=None):
         if line_item_id is not None:
             print('Warning: lineItemId currently not supported')
         return self.multi_update_basket([(product_id, quantity)])
 
+    def bisect_update_basket(self, id_qs, basket):
+        """ Like multi_update_basket, but if Coop rejects the batch because some
+        products are no longer available, the bad products are isolated by splitting
+        the batch in halves recursively. That takes O(k log n) requests for k bad
+        products. basket is the basket the changes are made to. The accepted halves
+        change the basket while isolating, and a rejected batch may have changed it
+        too, so afterwards the basket is fetched again and what is still missing for
+        the good products is sent in one final update.
+        Returns the resulting basket (or None) and the rejected (id, quantity) pairs. """
+        res = self.multi_update_basket(id_qs)
+        if not is_unavailable(res):
+            return res, []
+        if len(id_qs) == 1:
+            return None, list(id_qs)
+        rejected = self._isolate_unavailable(id_qs)
+        bad = {pid for pid, _ in rejected}
+        target = collections.Counter()
+        for item in basket['lineItems']:
+            target[item['product']['id']] += item['quantity']
+        for pid, q in id_qs:
+            if pid not in bad:
+                target[pid] += q
+        current = self.get_basket(refresh=True)
+        updates = basket_delta(current, [(pid, q) for pid, q in target.items() if q > 0], bad)
+        if not updates:
+            return current, rejected
+        res = self.multi_update_basket(updates)
+        return (current if is_unavailable(res) else res), rejected
+
+    def _isolate_unavailable(self, id_qs):
+        """ The (id, quantity) pairs of a rejected batch that Coop rejects on their
+        own, see bisect_update_basket """
+        if len(id_qs) == 1:
+            return list(id_qs)
+        mid = len(id_qs) // 2
+        rejected = []
+        for half in id_qs[:mid], id_qs[mid:]:
+            if is_unavailable(self.multi_update_basket(half)):
+                rejected += self._isolate_unavailable(half)
+        return rejected
+
     def get_stock(self, pids, order_identifier, store_id, timeslot_id):
         r = self.post(API + 'stock/stock',
                       orderIdentifier=order_identifier,
@@ -195,12 +1114,49 @@ class Coop:
         # itemId: "5718146713030"
         # label: ""
         # quantity: 77
-        return json.loads(r.text)
+        stock = self._json(r, list[models.StockEntry])
+        if isinstance(stock, list) and not isinstance(r, CachedResponse):
+            self.history.add_stock(stock, timeslot_id)
+        return stock
+
+    def get_stock_by_id(self, pids, order_identifier, store_id, timeslot_id,
+                        chunk_size=None, retries=2):
+        """ Like get_stock, but asks for at most chunk_size products per request
+        and sends the requests concurrently. A failing chunk is retried on its own.
+        Returns a dict from itemId to stock. Products whose chunk keeps failing
+        have quantity None and the label 'Ukendt lager'. """
+        pids = list(dict.fromkeys(pids))
+        chunk_size = chunk_size or self.stock_chunk_size
+        chunks = [(pids[i:i + chunk_size], order_identifier, store_id, timeslot_id, retries)
+                  for i in range(0, len(pids), chunk_size)]
+        if len(chunks) == 1:
+            results = [self._get_stock_chunk(*chunks[0])]
+        else:
+            results = fan_out(self, '_get_stock_chunk', chunks)
+        available = {s['itemId']: s for stock in results for s in stock}
+        for pid in pids:
+            if pid not in available:
+                available[pid] = models.StockEntry(itemId=pid, quantity=None,
+                                                   label='Ukendt lager', cutOffExceeded=False)
+        return available
+
+    def _get_stock_chunk(self, pids, order_identifier, store_id, timeslot_id, retries):
+        for attempt in range(retries + 1):
+            try:
+                stock = self.get_stock(pids, order_identifier, store_id, timeslot_id)
+                if isinstance(stock, list):
+                    return stock
+            except (CoopError, ValueError) as e:
+                logging.debug('Stock chunk failed: %s', e)
+            if attempt < retries:
+                time.sleep(2 ** attempt)
+        print(f'Kunne ikke checke lager for {len(pids)} varer.')
+        return []
 
     def is_login(self):
         # Unfortunately we're not allowed to just call HEAD.
         r = self.get(API + 'coopmember/get')
-        return (r.status_code == 200), json.loads(r.text)
+        return (r.status_code == 200), self._json(r)
 
     def get_user_context(self, r=None):
         # User context contains this stuff:
@@ -217,7 +1173,7 @@ class Coop:
         # "memberNumber":"..."},
         # We can get the context from any page request (doesn't use the api)
         if r is None:
-            r = self.get('https://butik.mad.coop.dk/min-profil/profiloplysninger')
+            r = self.get(SITE + 'min-profil/profiloplysninger')
         userContext = re.search('userContext: ({.*?})', r.text).group(1)
         return json.loads(userContext)
 
@@ -226,19 +1182,93 @@ class Coop:
         # GET https://butik.mad.coop.dk/api/search/products?term=%2a&categories=326&lastFacet=sortby&sortby=Offers&pageSize=14
         # labels
         r = self.get(API + 'search/search', term=term, pageSize=n)
-        return json.loads(r.text)
+        res = self._json(r, models.Products)
+        self.catalog.add(products_of(res))
+        if not isinstance(r, CachedResponse):
+            self.history.add_products(products_of(res))
+        return res
 
     def getbyids(self, ids):
         r = self.get(API + 'search/getbyids', productids=ids)
-        return json.loads(r.text)
+        res = self._json(r, models.Products)
+        self.catalog.add(products_of(res))
+        if not isinstance(r, CachedResponse):
+            self.history.add_products(products_of(res))
+        return res
         # Extra arguments: pageSize=21&offersOnly=true
 
     def tophundred(self, limit=100):
         r = self.get(API + 'tophundred/get', maxresults=limit)
-        return json.loads(r.text)
+        res = self._json(r, models.Products)
+        self.catalog.add(products_of(res))
+        if not isinstance(r, CachedResponse):
+            self.history.add_products(products_of(res))
+        return res
         # Hvis et produkt er udgaaet kommer det ikke med i soegning, men kan stadig komme i tophundred.
         # Det har isInAssortment=false, hvor normale produkter har isInAssortment=true.
 
+    def find_products(self, term, n=10):
+        """ Searches the local catalog, and only asks Coop if nothing is found there """
+        products = self.catalog.search(term, n)
+        if not products:
+            products = products_of(self.search(term, n=n))
+        return products
+
+
+def is_unavailable(res):
+    return (res.get('messages') or [''])[0] == UNAVAILABLE_MESSAGE
+
+
+class AsyncCoop:
+    """ Asyncio counterpart to Coop. Has the same methods, but they return
+    coroutines, so independent calls can be awaited concurrently. The calls run
+    on the pooled session of the wrapped Coop, at most `concurrency` at a time. """
+
+    def __init__(self, coop, concurrency=None):
+        self.coop = coop
+        self.semaphore = asyncio.Semaphore(concurrency or coop.concurrency)
+
+    def __getattr__(self, name):
+        method = getattr(self.coop, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            async with self.semaphore:
+                return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+
+def fan_out(coop, name, arg_list):
+    """ Calls the Coop method `name` once for each tuple of arguments in
+    arg_list, concurrently. Returns the results in the same order. """
+    async def run():
+        method = getattr(AsyncCoop(coop), name)
+        return await asyncio.gather(*(method(*args) for args in arg_list))
+    return asyncio.run(run())
+
+
+def fan_out_as_completed(coop, name, arg_list):
+    """ Like fan_out, but yields (args, result) pairs as soon as each call finishes """
+    method = getattr(coop, name)
+    with concurrent.futures.ThreadPoolExecutor(coop.concurrency) as pool:
+        # Each call runs in a copy of the context, like asyncio.to_thread does
+        futures = {pool.submit(contextvars.copy_context().run, method, *args): args
+                   for args in arg_list}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
+def record_value(obj):
+    """ json value of the models and dates in a record """
+    return obj.to_json() if isinstance(obj, models.Model) else str(obj)
+
+
+def emit(args, record):
+    """ Writes a record for --format ndjson, right away """
+    args.records.write(json.dumps(record, ensure_ascii=False, default=record_value) + '\n')
+    args.records.flush()
+
 
 def bold_text(text):
     return f"\033[1m{text}\033[0m"
@@ -251,6 +1281,8 @@ def basket(coop, args):
         basket_write(coop, args)
     elif args.read:
         basket_read(coop, args)
+    elif args.sync:
+        basket_sync(coop, args)
     else:
         basket_show(coop, args)
 
@@ -273,11 +1305,17 @@ def basket_write(coop, args):
         writer.writerow([item['quantity'], f"{display_name} [{pid}]"])
 
 
-def basket_read(coop, args):
-    quantities = []  # Amount we want of each product. (q, name, [ids])
-    reader = csv.reader(args.read)
-    for row in reader:
-        if not row or row[0].strip()[0] == '#':
+def iter_list(file, base, seen=frozenset()):
+    """ Yields the (q, name, [ids]) lines of a csv shopping list one at a time.
+    Lines like `#include FILE` insert another list, relative to `base`. """
+    for row in csv.reader(file):
+        if not row or not row[0].strip():
+            continue
+        first = row[0].strip()
+        if first.startswith('#include'):
+            yield from iter_list_files(first[len('#include'):].strip(), base, seen)
+            continue
+        if first[0] == '#':
             # Ignoring comments
             continue
         q, prod_name, *ids = row
@@ -285,94 +1323,294 @@ def basket_read(coop, args):
         for pid in ids:
             # Remove comments
             pid = re.sub(r'\(.*?\)', '', pid).strip()
-            pids.append(pid)
-        quantities.append((int(q), prod_name, pids))
-    # Set of all pids used in any alternatives - for checking stock
-    all_pids = {pid for _, _, pids in quantities for pid in pids}
+            if pid:
+                pids.append(pid)
+        yield int(q), prod_name, pids
 
 
+def iter_list_files(pattern, base=pathlib.Path('.'), seen=frozenset()):
+    """ Like iter_list for every file matching the glob pattern """
+    if any(c in pattern for c in '*?['):
+        paths = [pathlib.Path(p) for p in sorted(glob.glob(str(base / pattern)))]
+    else:
+        paths = [base / pattern]
+    if not paths:
+        sys.exit(f'Ingen filer passer med {base / pattern}')
+    for path in paths:
+        path = path.resolve()
+        if path in seen:
+            sys.exit(f'{path} inkluderer sig selv')
+        with path.open(newline='') as f:
+            yield from iter_list(f, path.parent, seen | {path})
+
+
+def read_list(sources, catalog=None):
+    """ Reads csv shopping lists, given as file names, glob patterns or open files.
+    Returns a list of (q, name, [ids]) with the amount we want of each product and
+    the product ids in order of preference. Lines starting with the same product
+    are merged. Products the catalog knows are delisted are left out. """
+    lines = {}  # First product id -> [q, name, ids]
+    for source in sources:
+        if isinstance(source, str):
+            rows = iter_list_files(source)
+        else:
+            rows = iter_list(source, pathlib.Path('.'))
+        for q, prod_name, pids in rows:
+            if not pids:
+                print(f'Intet produkt-id for "{prod_name}". Springer over.')
+                continue
+            line = lines.get(pids[0])
+            if line is None:
+                lines[pids[0]] = [q, prod_name, pids]
+            else:
+                line[0] += q
+                line[2] += [pid for pid in pids if pid not in line[2]]
+    quantities = [tuple(line) for line in lines.values()]
+    if catalog is not None:
+        delisted = catalog.delisted({pid for _, _, pids in quantities for pid in pids})
+        for pid in delisted:
+            print(f'{pid} er udgået. Prov at slette den fra filen.')
+        quantities = [(q, prod_name, [pid for pid in pids if pid not in delisted])
+                      for q, prod_name, pids in quantities]
+        for q, prod_name, pids in quantities:
+            if not pids:
+                print(f'Alle varer for "{prod_name}" er udgået.')
+        quantities = [line for line in quantities if line[2]]
+    return quantities
+
+
+def allocate(quantities, stock, prices=None, step_cost=0):
+    """ Spreads the stock over the lines of a shopping list. quantities are
+    (wanted, name, pids) lines with the ids in order of preference, and stock maps
+    ids to the number available. With prices, alternatives are ranked by price
+    plus step_cost for each step down the list of preference instead.
+
+    Every line first takes what it can of its best ranked products. Lines that come
+    up short then take stock over from lines that can make do with another of their
+    alternatives, along augmenting paths like in bipartite matching, so shared stock
+    is never promised twice and as much of the list as possible is filled.
+    Returns a Counter of {pid: n} for each line and the number each line is short. """
+    left = {pid: max(0, stock.get(pid, 0)) for _, _, pids in quantities for pid in pids}
+    choices = []
+    for _, _, pids in quantities:
+        pids = list(dict.fromkeys(pids))
+        if prices is not None:
+            rank = {pid: r for r, pid in enumerate(pids)}
+            pids.sort(key=lambda pid: (prices.get(pid, math.inf) + step_cost * rank[pid],
+                                       rank[pid]))
+        choices.append(pids)
+    taken = [collections.Counter() for _ in quantities]
+    holders = collections.defaultdict(set)  # pid -> lines that have taken some of it
+    short = [wanted for wanted, _, _ in quantities]
+
+    def move(line, pid, n):
+        taken[line][pid] += n
+        if taken[line][pid] > 0:
+            holders[pid].add(line)
+        else:
+            del taken[line][pid]
+            holders[pid].discard(line)
+
+    # Lines with few alternatives have the least room to move, so they go first
+    for line in sorted(range(len(quantities)), key=lambda line: len(choices[line])):
+        for pid in choices[line]:
+            n = min(short[line], left[pid])
+            if n > 0:
+                move(line, pid, n)
+                left[pid] -= n
+                short[line] -= n
+            if not short[line]:
+                break
+
+    # Products from which no path leads to spare stock. Moving stock along paths
+    # never creates new ones from them, so they are skipped from then on.
+    dead = set()
+    for line in range(len(quantities)):
+        while short[line]:
+            # Breadth first search from the products of the line to one with stock
+            # left. parent[pid] is (previous pid, line giving it up for pid).
+            parent = {pid: (None, line) for pid in choices[line] if pid not in dead}
+            queue = collections.deque(parent)
+            end = None
+            while queue and end is None:
+                pid = queue.popleft()
+                if left[pid] > 0:
+                    end = pid
+                    break
+                for other in holders[pid]:
+                    for alternative in choices[other]:
+                        if alternative not in parent and alternative not in dead:
+                            parent[alternative] = (pid, other)
+                            queue.append(alternative)
+            if end is None:
+                dead.update(parent)
+                break
+            path = []
+            pid = end
+            while pid is not None:
+                previous, other = parent[pid]
+                path.append((previous, other, pid))
+                pid = previous
+            n = min([short[line], left[end]]
+                    + [taken[other][previous] for previous, other, _ in path if previous])
+            for previous, other, pid in path:
+                if previous is not None:
+                    move(other, previous, -n)
+                move(other, pid, n)
+            left[end] -= n
+            short[line] -= n
+    return taken, short
+
+
+def choose_products(coop, quantities, basket, step_cost=None):
+    """ Picks products for each line of the list, using alternatives for what
+    is out of stock, see allocate. Returns the (id, quantity) pairs to order, the
+    (n, prod_name) that couldn't be found and the ids of the lines whose stock
+    couldn't be checked. Those lines are left out of the order, and their products
+    shouldn't be changed. If step_cost is given, cheaper alternatives are
+    preferred when they save more than step_cost kr. per step down the list. """
     print('Checker om varerne er tilgængelige...')
-    missing = []  # [(n, prod_name)]
-    basket = coop.get_basket()
     if basket['timeSlot'] is None:
         print('Intet tidspunkt valgt. Kan ikke checke stock.')
         print('Kør "coop.py tidspunkt --pick" for automatisk at vælge et tidspunkt.')
-        order = [(pids[0], q) for q, _, pids in quantities]
-    else:
+        return [(pids[0], q) for q, _, pids in quantities], [], set()
 
-        # Sometimes get_stock seems to return positive amounts for products that
-        # we can't buy anyway. Maybe using getbyids would be helpful?
-        # But it may have been deprecated?
-        #res = coop.getbyids(list(all_pids))
-        
-        stock = coop.get_stock(
-            list(all_pids),
-            basket['orderIdentifier'],
-            basket['store']['id'],
-            basket['timeSlot']["timeSlotId"])
-        available = {s['itemId']: s for s in stock}
-        order = []
-        for wanted, prod_name, pids in quantities:
-            pid = pids[0]
+    # Set of all pids used in any alternatives - for checking stock
+    all_pids = list({pid for _, _, pids in quantities for pid in pids})
+
+    # Sometimes get_stock seems to return positive amounts for products that
+    # we can't buy anyway. Maybe using getbyids would be helpful?
+    # But it may have been deprecated?
+    #res = coop.getbyids(list(all_pids))
+
+    available = coop.get_stock_by_id(
+        all_pids,
+        basket['orderIdentifier'],
+        basket['store']['id'],
+        basket['timeSlot']["timeSlotId"])
+    # Lines with unknown stock are left alone rather than treated as sold out
+    unknown = {pid for pid, s in available.items() if s['quantity'] is None}
+    unchecked = [line for line in quantities if unknown.intersection(line[2])]
+    for _, prod_name, _ in unchecked:
+        print(f'Springer "{prod_name}" over, da lageret ikke kunne checkes.')
+    quantities = [line for line in quantities if not unknown.intersection(line[2])]
+    prices = None
+    if step_cost is not None:
+        chunks = [(all_pids[i:i + 100],) for i in range(0, len(all_pids), 100)]
+        prices = {p['id']: product_price(p)
+                  for res in fan_out(coop, 'getbyids', chunks) for p in products_of(res)}
+        prices = {pid: price for pid, price in prices.items() if price is not None}
+    with coop.phase('allocate'):
+        taken, short = allocate(quantities, {pid: s['quantity'] for pid, s in available.items()},
+                                prices, step_cost or 0)
+    names = coop.catalog.names(all_pids)
+    order = []
+    missing = []  # [(n, prod_name)]
+    for (wanted, prod_name, pids), line, n_short in zip(quantities, taken, short):
+        order += line.items()
+        pid = pids[0]
+        if line[pid] < wanted:
             q = available[pid]['quantity']
-            if q > 0:
-                order.append((pid, min(wanted, q)))
-            if wanted > q:
+            if q < wanted:
                 amount = f'kun {q}' if q > 0 else 'ingen'
-                print(
-                    f'Der er {amount} "{prod_name}" ({pid}) tilbage.',
-                    available[pid]['label'])
-                wanted -= q
-                for altid in pids[1:]:
-                    q = available[altid]['quantity']
-                    take = min(q, wanted)
-                    if take > 0:
-                        # TODO: Write a better name here?
-                        print(f'Tager {take} "{altid}" som alternativ.')
-                        order.append((altid, take))
-                        wanted -= take
-                if wanted > 0:
-                    missing.append((wanted, prod_name))
+                print(f'Der er {amount} "{prod_name}" ({pid}) tilbage.', available[pid]['label'])
+            for altid, take in line.items():
+                if altid != pid:
+                    print(f'Tager {take} "{names.get(altid) or altid}" ({altid}) som alternativ.')
+        if n_short:
+            missing.append((n_short, prod_name))
+    return order, missing, {pid for _, _, pids in unchecked for pid in pids}
 
-    if missing:
-        print('\nNogle varer var ikke tilgængelige. Her er nogle alternativer til din fil:')
-        search_results = []
-        for wanted, prod_name in missing:
-            new_products = []
-            for p in coop.search(prod_name, n=3)['products']:
-                # Don't include those already in our document
-                if p['id'] not in all_pids:
-                    new_products.append(p)
-            search_results.append(new_products)
-        # Let's only show new products that are actually in stock
-        stock = coop.get_stock(
-            [p['id'] for prods in search_results for p in prods],
-            basket['orderIdentifier'], basket['store']['id'], basket['timeSlot']["timeSlotId"])
-        available = {s['itemId']: s for s in stock}
-        for (wanted, prod_name), new_products in zip(missing, search_results):
-            for p in new_products:
-                q = available[p['id']]['quantity']
-                if q > 0:
-                    print(f'{p["displayName"]}, {p["id"]} ({p["spotText"]}, Lager: {q})')
-        print()
 
+def suggest_alternatives(coop, missing, quantities, basket):
+    """ Prints products in stock that could replace the missing ones """
+    all_pids = {pid for _, _, pids in quantities for pid in pids}
+    print('\nNogle varer var ikke tilgængelige. Her er nogle alternativer til din fil:')
+    search_results = []
+    found = fan_out(coop, 'find_products', [(prod_name, 3) for _, prod_name in missing])
+    for products in found:
+        # Don't include those already in our document
+        new_products = [p for p in products if p['id'] not in all_pids]
+        search_results.append(new_products)
+    # Let's only show new products that are actually in stock
+    available = coop.get_stock_by_id(
+        [p['id'] for prods in search_results for p in prods],
+        basket['orderIdentifier'], basket['store']['id'], basket['timeSlot']["timeSlotId"])
+    for (wanted, prod_name), new_products in zip(missing, search_results):
+        for p in new_products:
+            q = available[p['id']]['quantity']
+            if q:
+                print(f'{p["displayName"]}, {p["id"]} ({p.get("spotText") or ""}, Lager: {q})')
+    print()
+
+
+def update_basket(coop, basket, updates):
+    print('Vent venligst...')
+    res, rejected = coop.bisect_update_basket(updates, basket)
+    for product_id, quantity in rejected:
+        print(f'Problemer med {product_id}. Prov at slette den fra filen.')
+    if res is not None:
+        print(f'Kurven har nu {len(res["lineItems"])} varer.')
 
 
+def basket_read(coop, args):
+    with coop.phase('csv'):
+        quantities = read_list(args.read, coop.catalog)
+    basket = coop.get_basket()
+    order, missing, _ = choose_products(coop, quantities, basket, step_cost=args.prefer_cheap)
+    if missing:
+        suggest_alternatives(coop, missing, quantities, basket)
     if order and not args.test:
-        print('Vent venligst...')
-        res = coop.multi_update_basket(order)
-        bad_res = lambda r: r.get('messages', [''])[0] == 'Et eller flere produkter er ikke længere tilgængelige'
-        if bad_res(res):
-            for product_id, quantity in order:
-                res = coop.update_basket(product_id, quantity)
-                if bad_res(res):
-                    print(f'Problemer med {product_id}. Prov at slette den fra filen.')
-        else:
-            print(f'Kurven har nu {len(res["lineItems"])} varer.')
+        update_basket(coop, basket, order)
+
+
+def basket_delta(basket, order, keep=()):
+    """ The (id, change in quantity) pairs that turn the basket into order.
+    The products in keep are left as they are. """
+    current = collections.Counter()
+    for item in basket['lineItems']:
+        current[item['product']['id']] += item['quantity']
+    desired = collections.Counter()
+    for pid, q in order:
+        desired[pid] += q
+    return [(pid, desired[pid] - current[pid])
+            for pid in list(desired) + [pid for pid in current if pid not in desired]
+            if desired[pid] != current[pid] and pid not in keep]
+
+
+def basket_sync(coop, args):
+    """ Makes the basket contain exactly the products from the file, sending only
+    the differences in a single update. """
+    with coop.phase('csv'):
+        quantities = read_list(args.sync, coop.catalog)
+    basket = coop.get_basket()
+    order, missing, unchecked = choose_products(coop, quantities, basket,
+                                                step_cost=args.prefer_cheap)
+    if missing:
+        suggest_alternatives(coop, missing, quantities, basket)
+    updates = basket_delta(basket, order, unchecked)
+    if not updates:
+        print('Kurven passer allerede med filen.')
+    elif not args.test:
+        print(f'Ændrer {len(updates)} varer...')
+        update_basket(coop, basket, updates)
 
 
 def basket_show(coop, args):
     basket = coop.get_basket()
+    if args.format == 'ndjson':
+        for item in basket['lineItems']:
+            product = item['product']
+            emit(args, dict(type='basket_line', id=product['id'], name=product['displayName'],
+                            category=product['category'], quantity=item['quantity'],
+                            spotText=product.get('spotText')))
+        emit(args, dict(
+            type='basket', lines=len(basket['lineItems']),
+            count=sum(item['quantity'] for item in basket['lineItems']),
+            total=basket['totals']['subTotal']['formattedAmountLong'],
+            timeSlot=basket['timeSlot'] and basket['timeSlot']['deliveryDescription'],
+            store=basket['timeSlot'] and basket['store']['address']))
+        return
     #   print(json.dumps(basket, indent=3))
     categories = collections.defaultdict(list)
     for item in basket['lineItems']:
@@ -397,152 +1635,734 @@ def basket_show(coop, args):
         print('Butik:', basket['store']['address'])
 
 
+def line_items(details):
+    """ All line items of an order from the order history """
+    for cat in details['categories']:
+        yield from cat['lineItems']
+
+
+def item_pid(item, ids):
+    """ The product id of an order history line item, from its image url or from
+    the ids of resolve_names. None if neither has it. """
+    return line_item_pid(item) or ids.get(item['displayName'])
+
+
+def write_order(file, details, ids):
+    """ Writes an order from the order history as a shopping list """
+    writer = list_writer(file)
+    for cat in details['categories']:
+        writer.writerow([])
+        writer.writerow([f"# {cat['name']}"])
+        for item in cat['lineItems']:
+            writer.writerow([item['quantity'], item['displayName'], item_pid(item, ids) or ''])
+
+
+def same_name(a, b):
+    """ Whether two product names are equal apart from case and spacing """
+    return a.casefold().split() == b.casefold().split()
+
+
+def resolve_names(coop, items, online=True):
+    """ Looks up product ids by name for the order history line items whose image
+    url has no id: first among the names resolved before, then in the catalog.
+    If online, the names still missing are looked up among the most bought
+    products, and the rest by searching Coop. Coop has no lookup of many names
+    at once (search/getbyids takes ids), so that is one search per name, sent
+    concurrently. Returns a dict from display name to id for the names found. """
+    names = {item['displayName'] for item in items if line_item_pid(item) is None}
+    found = coop.catalog.lookups(names)
+    found.update(coop.catalog.name_ids(names - found.keys()))
+    if online and names - found.keys():
+        # One request that adds the products bought most often to the catalog
+        coop.tophundred()
+        found.update(coop.catalog.name_ids(names - found.keys()))
+    missing = sorted(names - found.keys())
+    if online and missing:
+        results = fan_out(coop, 'search', [(name,) for name in missing])
+        searched = {name: next((p['id'] for p in products_of(res)
+                                if same_name(p['displayName'], name)), None)
+                    for name, res in zip(missing, results)}
+        coop.catalog.add_lookups(searched)
+        found.update(searched)
+    return {name: pid for name, pid in found.items() if pid is not None}
+
+
+def list_writer(file):
+    """ A csv writer for a shopping list, with the explanatory header written """
+    writer = csv.writer(file, dialect='excel')
+    writer.writerow(['# Dette er en coop.py bestillingsliste.'])
+    writer.writerow(['# Kolonne 1 er antal; kolonne 2 er et kaldenavn; og de'])
+    writer.writerow(
+        ['# resterende kolonner er produkt-id\'er i prioriteret orden.'])
+    writer.writerow(['# Alle felter kan indeholde kommentarer i (parentes).'])
+    return writer
+
+
+def order_matrix(details, ids=None):
+    """ Turns order details (oldest first) into an orders × products matrix of
+    quantities. Returns the matrix along with the product ids, names and
+    categories of its columns. ids are names resolved by resolve_names.
+    Line items without a product id are left out. """
+    import numpy as np
+    index = {}  # pid -> column
+    names, categories = [], []
+    rows, cols, quantities = [], [], []
+    for row, detail in enumerate(details):
+        for cat in detail['categories']:
+            for item in cat['lineItems']:
+                pid = item_pid(item, ids or {})
+                if pid is None:
+                    continue
+                col = index.setdefault(pid, len(index))
+                if col == len(names):
+                    names.append(None)
+                    categories.append(None)
+                # Later orders overwrite, so the newest name is kept
+                names[col], categories[col] = item['displayName'], cat['name']
+                rows.append(row)
+                cols.append(col)
+                quantities.append(item['quantity'])
+    matrix = np.zeros((len(details), len(index)))
+    np.add.at(matrix, (rows, cols), quantities)
+    return matrix, list(index), names, categories
+
+
+def suggest_order(matrix, names, categories, min_count=3, max_alternatives=2):
+    """ Picks the products that are due in the next order, judging by how often
+    each product has been bought before. Returns a list of (column, quantity,
+    interval, alternative columns), where interval is the typical number of orders
+    between purchases. Alternatives are products from the same category that have
+    never been bought together with the product, i.e. that have stood in for it. """
+    import numpy as np
+    n = len(matrix)
+    bought = matrix > 0
+    count = bought.sum(axis=0)
+    first = bought.argmax(axis=0)
+    last = n - 1 - bought[::-1].argmax(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        interval = np.where(count > 1, (last - first) / (count - 1), np.inf)
+    quantity = np.nanmedian(np.where(bought, matrix, np.nan), axis=0)
+    since = n - last  # Orders since the last purchase, counting the next one
+    # Products not bought for much longer than usual have probably been given up
+    due = (count >= min_count) & (since >= np.round(interval)) & (since <= 2 * interval + 1)
+    chosen = np.flatnonzero(due)
+
+    # Orders where both a chosen product and another product were bought
+    together = bought[:, chosen].T.astype(np.int32) @ bought.astype(np.int32)
+    _, category = np.unique(categories, return_inverse=True)
+    words = {}
+    suggestions = []
+    for row, col in enumerate(chosen):
+        candidates = np.flatnonzero((together[row] == 0) & (category == category[col]) & ~due)
+        for c in [col, *candidates]:
+            if c not in words:
+                words[c] = set(re.findall(r'\w{3,}', names[c].lower()))
+        candidates = [c for c in candidates if words[c] & words[col] or count[c] > 1]
+        candidates.sort(key=lambda c: (-len(words[c] & words[col]), -count[c]))
+        suggestions.append((col, max(1, round(quantity[col])), interval[col],
+                            candidates[:max_alternatives]))
+    return suggestions
+
+
+def suggest(coop, file):
+    try:
+        import numpy as np  # noqa: F401
+    except ImportError:
+        sys.exit('ordrer --suggest kræver NumPy: pip install numpy')
+    details = coop.order_store.details()
+    if not details:
+        sys.exit('Ingen ordrer i ordrehistorikken.')
+    ids = resolve_names(coop, [item for detail in details for item in line_items(detail)])
+    matrix, pids, names, categories = order_matrix(details, ids)
+    suggestions = suggest_order(matrix, names, categories)
+    delisted = coop.catalog.delisted(pids)
+    writer = list_writer(file)
+    by_category = collections.defaultdict(list)
+    for col, quantity, interval, alternatives in suggestions:
+        choices = [c for c in [col] + alternatives if pids[c] not in delisted]
+        if choices:
+            by_category[categories[col]].append((names[col], quantity, interval, choices))
+    for cat, lines in sorted(by_category.items()):
+        writer.writerow([])
+        writer.writerow([f'# {cat}'])
+        for prod_name, quantity, interval, choices in sorted(lines):
+            writer.writerow(
+                [quantity, prod_name, f'{pids[choices[0]]} (hver {interval:.0f}. ordre)']
+                + [f'{pids[c]} ({names[c]})' for c in choices[1:]])
+    print(f'Foreslog {sum(map(len, by_category.values()))} varer ud fra {len(details)} ordrer.',
+          file=sys.stderr)
+
+
+def order_record(order):
+    return dict(type='order', orderIdentifier=order['orderIdentifier'],
+                orderNumber=order['orderNumber'], deliveryTime=order['deliveryTime'],
+                price=order['price']['formattedAmount'], isEditable=order['isEditable'])
+
+
 def orders(coop, args):
     N = 10
-    orders = coop.get_invoiced_orders(n=N)
-    orders.sort(key=lambda o: o['orderNumber'], reverse=True)
+    if args.sync:
+        print('Henter ordrer...')
+        new = coop.sync_orders()
+        print(f'Hentede {new} nye ordrer.')
+    elif args.suggest or args.export or len(coop.order_store):
+        # Once there is an order history, keep it up to date. That only
+        # downloads the orders that are new since the last run.
+        coop.sync_orders()
+    if args.export:
+        export_orders(coop, pathlib.Path(args.export))
+        return
+    if args.suggest:
+        suggest(coop, args.write or sys.stdout)
+        return
+    if args.format == 'ndjson' and args.n is None:
+        # Stream the whole history, a page at a time
+        if len(coop.order_store):
+            stream = coop.order_store.iter_orders()
+        else:
+            stream = coop.iter_invoiced_orders()
+        for order in stream:
+            emit(args, order_record(order))
+        return
+    if len(coop.order_store):
+        orders = coop.order_store.orders()
+    else:
+        orders = coop.get_invoiced_orders(n=N)
+        orders.sort(key=lambda o: o['orderNumber'], reverse=True)
     if args.n is None:
         print('Tidligere ordrer:')
-        for i, order in enumerate(orders):
+        for i, order in enumerate(orders[:N]):
             e = '(e)' if order['isEditable'] else ''
             print(f"[{i}] {order['deliveryTime']}. Pris: {order['price']['formattedAmount']} {e}")
+        if len(orders) > N:
+            print(f'... og {len(orders) - N} ældre.')
     else:
-        assert args.n in range(N)
+        assert args.n in range(len(orders))
         order = orders[args.n]
-        details = coop.get_order_history_detail(order['orderIdentifier'])
-        if args.write:
-            writer = csv.writer(args.write, dialect='excel')
-            writer.writerow(['# Dette er en coop.py bestillingsliste.'])
-            writer.writerow(['# Kolonne 1 er antal; kolonne 2 er et kaldenavn; og de'])
-            writer.writerow(
-                ['# resterende kolonner er produkt-id\'er i prioriteret orden.'])
-            writer.writerow(['# Alle felter kan indeholde kommentarer i (parentes).'])
+        details = coop.order_store.detail(order['orderIdentifier'])
+        if details is None:
+            details = coop.get_order_history_detail(order['orderIdentifier'],
+                                                    order['isEditable'])
+        # Only a list that is written is worth searching Coop for the missing ids
+        ids = resolve_names(coop, list(line_items(details)), online=bool(args.write))
+        if args.format == 'ndjson' and not args.write:
             for cat in details['categories']:
-                writer.writerow([])
-                writer.writerow([f"# {cat['name']}"])
                 for item in cat['lineItems']:
-                    display_name = item['displayName']
-                    # TODO: This image url thing is a hack :(
-                    pid = re.search(r'products/(\d+?).png', str(item['imageUrl']))
-                    writer.writerow([item['quantity'], display_name,
-                                     pid.group(1) if pid else ''])
+                    emit(args, dict(type='order_line', orderIdentifier=order['orderIdentifier'],
+                                    category=cat['name'], name=item['displayName'],
+                                    quantity=item['quantity'], id=item_pid(item, ids)))
+        elif args.write:
+            write_order(args.write, details, ids)
         else:
             for cat in sorted(details['categories'], key=lambda c: c['name']):
                 print(bold_text(cat['name']))
                 for item in sorted(cat['lineItems'], key=lambda i: i['displayName']):
                     # There is also something called originalQuantity
-                    pid = re.search(r'products/(\d+?).png', str(item['imageUrl']))
                     print(
                         item['quantity'],
                         item['displayName'],
-                        pid.group(1) if pid else '')
+                        item_pid(item, ids) or '')
                 print()
 
 
-def slot_loss(slot, best_time):
-    """ Returns the distance between the given slot and best_time """
+def export_orders(coop, directory):
+    """ Writes every order in the order history to a shopping list in directory """
+    directory.mkdir(parents=True, exist_ok=True)
+    orders = coop.order_store.orders()
+    details = [coop.order_store.detail(order['orderIdentifier']) for order in orders]
+    # Editable orders may still change, so their details are never stored
+    missing = [i for i, detail in enumerate(details) if detail is None]
+    fetched = fan_out(coop, 'get_order_history_detail',
+                      [(orders[i]['orderIdentifier'], orders[i]['isEditable'])
+                       for i in missing])
+    for i, detail in zip(missing, fetched):
+        details[i] = detail
+    ids = resolve_names(coop, [item for detail in details for item in line_items(detail)])
+    unresolved = 0
+    for order, detail in zip(orders, details):
+        with open(directory / f"ordre-{order['orderNumber']}.csv", 'w', newline='') as f:
+            write_order(f, detail, ids)
+        unresolved += sum(item_pid(item, ids) is None for item in line_items(detail))
+    print(f'Skrev {len(orders)} ordrer til {directory}.', file=sys.stderr)
+    if unresolved:
+        print(f'Fandt ikke produkt-id for {unresolved} varer.', file=sys.stderr)
+
+
+def slot_loss(slot, start, end=None):
+    """ Returns the distance in hours between the given slot and the hours from
+    start to end, or just start """
     if slot['soldOut'] or slot['isSpecialSlot']:
         return 10
     m = re.search(r'(\d+)-(\d+)', slot['displayName'])
     a, b = map(int, m.groups())
-    # Compute distance from best_time to the interval [a,b]
-    return max(best_time - b, a - best_time, 0)
+    # Compute distance from the interval [start,end] to the interval [a,b]
+    return max(start - b, a - (start if end is None else end), 0)
+
 
+def slot_price(slot):
+    """ The delivery price of a slot, or None if the response doesn't have it.
+    The name of the field hasn't been confirmed in a real response. """
+    return product_price(slot, ('deliveryPrice', 'price'))
 
-def pick_timeslot(coop, weekday, hour):
+
+def fetch_timeslots(coop, weekdays, weeks, cached=True):
+    """ Fetches the timeslots of every store for every date on the weekdays in the
+    coming weeks, concurrently. Returns (store, date of the slot day, slot day)
+    for each slot day on one of the weekdays, without duplicates. """
     stores = coop.get_stores()
-    if len(stores) > 1:
-        print('Der er flere butikker tilgængelige:',
-              ', '.join(s['address'] for s in stores))
-    store_id = stores[0]['id']
-
-    # It seems we sometimes need the to be specified in the request.
-    # The behaviour seems unstable.
-    date = datetime.date.today()
-    while date.weekday() != weekday:
-        date += datetime.timedelta(days=1)
-
-    slots = coop.get_timeslots(is_home_delivery=True, store_id=store_id, date=date)
-    for slot_day in slots['timeSlotDeliveryDays']:
-        # Pick first Wednesday
-        if datetime.datetime.fromisoformat(slot_day['deliveryDate']).weekday() == weekday:
-            # Pick timeslot not too far away fom 6pm
-            q = 10**10  # No timeslots == very bad quality.
-            if slot_day['timeSlots']:
-                q, _, _, best = min(
-                    (slot_loss(s, hour), s['displayName'], float('NaN'), s) for s in slot_day['timeSlots'])
-            if q > 1:  # Acceptable quality
-                print(f'Kunne ikke finde godt tidspunkt {day}.')
-                print(f'Skriv `python coop.py tidspunkt` for at se alle muligeheder.')
-                return None
-            res = coop.check_slot(best['timeSlotId'], store_id)
-            # {"totalPriceChange":null,"unavailableProducts":null,"changedProducts":null,"isCheaper":null}
-            res = coop.set_delivery_options(
-                best['timeSlotId'], store_id, is_home_delivery=True)
-            return best, res
+    today = datetime.date.today()
+    dates = [today + datetime.timedelta(days=d) for d in range(7 * weeks)
+             if (today + datetime.timedelta(days=d)).weekday() in weekdays]
+    calls = [(True, store['id'], date, cached) for store in stores for date in dates]
+    days = {}  # (store id, date) -> slot day
+    for (_, store_id, _, _), slots in zip(calls, fan_out(coop, 'get_timeslots', calls)):
+        store = next(s for s in stores if s['id'] == store_id)
+        for slot_day in slots['timeSlotDeliveryDays']:
+            date = datetime.datetime.fromisoformat(slot_day['deliveryDate']).date()
+            if date.weekday() in weekdays and date < today + datetime.timedelta(weeks=weeks):
+                days[store_id, date] = (store, date, slot_day)
+    return list(days.values())
+
+
+def plan_timeslots(coop, weekdays, hours, weeks=2, hour_cost=None, n=5):
+    """ Ranks the free slots of every store in the coming weeks. A slot costs its
+    distance in hours from the wanted hours (start or (start, end)). If hour_cost
+    is given, the delivery price is added, with an hour away counting as hour_cost
+    kr. Otherwise the price only breaks ties. A missing price counts as 0 kr.
+    Returns the n best as (hours away, price or None, date, slot, store), best first. """
+    candidates = []
+    for store, date, slot_day in fetch_timeslots(coop, weekdays, weeks):
+        for slot in slot_day['timeSlots']:
+            if slot['soldOut'] or slot['isSpecialSlot']:
+                continue
+            loss, price = slot_loss(slot, *hours), slot_price(slot)
+            cost = price or 0
+            score = (loss * hour_cost + cost,) if hour_cost is not None else (loss, cost)
+            candidates.append((score, date, slot['timeSlotId'], loss, price, slot, store))
+    unpriced = sum(c[4] is None for c in candidates)
+    if candidates and unpriced == len(candidates):
+        print('Fandt ingen leveringspriser i svaret fra Coop, så tidspunkterne vælges '
+              'kun efter hvor tæt de er på det ønskede.')
+    elif unpriced and hour_cost is not None:
+        print(f'{unpriced} tidspunkter har ingen leveringspris og tæller som 0 kr.')
+    candidates.sort()
+    return [(loss, price, date, slot, store)
+            for _, date, _, loss, price, slot, store in candidates[:n]]
+
+
+def pick_timeslot(coop, plan, weekdays, tolerance=1):
+    """ Books the best slot of a plan from plan_timeslots, if it is good enough """
+    if not plan or plan[0][0] > tolerance:
+        days = ', '.join(WEEKDAYS[d] for d in sorted(weekdays))
+        print(f'Kunne ikke finde godt tidspunkt {days}.')
+        print(f'Skriv `python coop.py tidspunkt` for at se alle muligeheder.')
+        return None
+    _, _, _, best, store = plan[0]
+    return best, book_slot(coop, best, store['id'])
+
+
+def watch_timeslots(coop, weekdays, hours, tolerance=1, weeks=2,
+                    min_interval=5, max_interval=120):
+    """ Polls the timeslots of every store on the weekdays of the coming `weeks`,
+    and books the first slot within `tolerance` hours of `hours` that becomes free.
+    Polls quickly while slots are changing and backs off while nothing happens. """
+    print(f'Holder øje med {len(weekdays) * weeks} dage i alle butikker. Stop med Ctrl-C.')
+    sold_out = {}  # timeSlotId -> soldOut at the last poll
+    interval = min_interval
+    while True:
+        try:
+            # The short lived cache would hide slots becoming free
+            days = fetch_timeslots(coop, weekdays, weeks, cached=False)
+        except CoopError as e:
+            print(e)
+            interval = min(max_interval, interval * 2)
+            time.sleep(interval)
+            continue
+        changed = 0
+        freed = []
+        for store, date, slot_day in days:
+            for slot in slot_day['timeSlots']:
+                before = sold_out.get(slot['timeSlotId'])
+                sold_out[slot['timeSlotId']] = slot['soldOut']
+                if before == slot['soldOut']:
+                    continue
+                changed += before is not None
+                loss = slot_loss(slot, *hours)
+                if not slot['soldOut'] and loss <= tolerance:
+                    freed.append((loss, date, slot['timeSlotId'], slot, store['id']))
+        if freed:
+            _, _, _, slot, store_id = min(freed)
+            return slot, book_slot(coop, slot, store_id)
+        # Poll faster when slots are moving, slower when nothing happens
+        interval = min_interval if changed else min(max_interval, interval * 1.5)
+        logging.debug('%d slots changed, polling again in %.0fs', changed, interval)
+        time.sleep(interval * random.uniform(.8, 1.2))
+
+
+def book_slot(coop, slot, store_id):
+    coop.check_slot(slot['timeSlotId'], store_id)
+    # {"totalPriceChange":null,"unavailableProducts":null,"changedProducts":null,"isCheaper":null}
+    return coop.set_delivery_options(slot['timeSlotId'], store_id, is_home_delivery=True)
+
+
+def slot_record(slot, store, date):
+    return dict(type='slot', store=store['address'], storeId=store['id'], date=date,
+                timeSlotId=slot['timeSlotId'], displayName=slot['displayName'],
+                deliveryDescription=slot.get('deliveryDescription'), soldOut=slot['soldOut'],
+                isSpecialSlot=slot['isSpecialSlot'], price=slot_price(slot))
 
 
 def timeslot(coop, args):
-    if args.pick:
-        slot, basket = pick_timeslot(coop, args.day, int(args.hour))
+    if len(args.hour) > 2:
+        sys.exit('--hour tager en time eller et interval: FRA TIL')
+    if args.watch:
+        slot, basket = watch_timeslots(coop, args.day, args.hour, args.tolerance, args.weeks)
+        if args.format == 'ndjson':
+            emit(args, dict(type='booked', timeSlotId=slot['timeSlotId'],
+                            deliveryDescription=slot['deliveryDescription']))
+        print('Valgte:', slot["deliveryDescription"])
+        if 'deliveryCheckoutMessage' in basket:
+            print(basket['deliveryCheckoutMessage'])
+    elif args.pick:
+        plan = plan_timeslots(coop, args.day, args.hour, args.weeks, args.hour_cost)
+        if args.format == 'ndjson':
+            for loss, price, date, slot, store in plan:
+                emit(args, dict(slot_record(slot, store, date), type='slot_candidate',
+                                hoursAway=loss))
+        elif plan:
+            print('Bedste tidspunkter:')
+            for loss, price, date, slot, store in plan:
+                price = 'ukendt pris' if price is None else f'{price:g} kr.'
+                print(f"  {slot['deliveryDescription']}, {store['address']} "
+                      f"({loss} timer fra ønsket, {price})")
+        picked = pick_timeslot(coop, plan, args.day, args.tolerance)
+        if picked is None:
+            sys.exit(1)
+        slot, basket = picked
+        if args.format == 'ndjson':
+            emit(args, dict(type='booked', timeSlotId=slot['timeSlotId'],
+                            deliveryDescription=slot['deliveryDescription']))
         print('Valgte:', slot["deliveryDescription"])
         if not 'deliveryCheckoutMessage' in basket:
             pass
             #print(json.dumps(basket, indent=3))
         else:
             print(basket['deliveryCheckoutMessage'])
+    elif args.format == 'ndjson':
+        stores = {store['id']: store for store in coop.get_stores()}
+        calls = [(True, store_id) for store_id in stores]
+        # Each store is written as soon as its slots arrive
+        for (_, store_id), slots in fan_out_as_completed(coop, 'get_timeslots', calls):
+            for slot_day in slots['timeSlotDeliveryDays']:
+                date = slot_day['deliveryDate'][:10]
+                for slot in slot_day['timeSlots']:
+                    emit(args, slot_record(slot, stores[store_id], date))
     else:
         stores = coop.get_stores()
-        if len(stores) > 1:
-            print('Der er flere butikker tilgængelige:',
-                  ', '.join(s['address'] for s in stores))
-        print('Butik:', stores[0]['address'])
-        store_id = stores[0]['id']
-        slots = coop.get_timeslots(is_home_delivery=True, store_id=store_id)
-        i = 0
-        for slot_day in slots['timeSlotDeliveryDays']:
-            print(bold_text(slot_day['deliveryDateFormattedLong']))
-            for slot in slot_day['timeSlots']:
-                avail = 'optaget' if slot['soldOut'] else 'fri'
-                if slot['isSpecialSlot']:
-                    avail += ', special'
-                print(f"[{i}] {slot['displayName']} ({avail})")
-                i += 1
-            print()
+        calls = [(True, store['id']) for store in stores]
+        for store, slots in zip(stores, fan_out(coop, 'get_timeslots', calls)):
+            print(bold_text(f"Butik: {store['address']}"))
+            i = 0
+            for slot_day in slots['timeSlotDeliveryDays']:
+                print(bold_text(slot_day['deliveryDateFormattedLong']))
+                for slot in slot_day['timeSlots']:
+                    avail = 'optaget' if slot['soldOut'] else 'fri'
+                    if slot['isSpecialSlot']:
+                        avail += ', special'
+                    print(f"[{i}] {slot['displayName']} ({avail})")
+                    i += 1
+                print()
 
 
 def test(coop, args):
     test_file = io.StringIO()
-    orders(coop, types.SimpleNamespace(n=0, write=test_file))
+    orders(coop, types.SimpleNamespace(n=0, write=test_file, sync=False, suggest=False,
+                                       export=None, format='text'))
     test_file.seek(0)  # Move file back to the beginning for reading
     basket(
         coop,
         types.SimpleNamespace(
-            read=test_file,
+            read=[test_file],
+            sync=None,
             clear=False,
             write=None,
-            test=False))
-    basket(coop, types.SimpleNamespace(clear=True, write=None, read=None))
+            test=False,
+            prefer_cheap=None,
+            format='text'))
+    basket(coop, types.SimpleNamespace(clear=True, write=None, read=None, sync=None,
+                                       format='text'))
 
 
 def search(coop, args):
-    products = coop.search(args.term, n=3)['products']
+    if args.online:
+        products = coop.search(args.term, n=3)['products']
+    else:
+        products = coop.find_products(args.term, n=3)
+    if args.format == 'ndjson':
+        for vare in products:
+            emit(args, dict(type='product', id=vare['id'], name=vare['displayName'],
+                            spotText=vare.get('spotText'),
+                            labels=vare.get('labels') or [],
+                            isInAssortment=vare.get('isInAssortment'), url=vare.get('url')))
+        return
     print()
     for vare in products:
         print(bold_text(vare['displayName']), '\tid:', vare['id'])
-        print(vare['spotText'])
-        if vare['labels']:
-            print(', '.join(l['displayName'] for l in vare['labels']))
-        print('https://butik.mad.coop.dk' + vare['url'])
+        if vare.get('spotText'):
+            print(vare['spotText'])
+        if vare.get('labels'):
+            print(', '.join(vare['labels']))
+        if vare.get('isInAssortment') is False:
+            print('Udgået')
+        if vare.get('url'):
+            print('https://butik.mad.coop.dk' + vare['url'])
         print()
 
 
+def price_stats(columns, window):
+    """ For each product with a known price: the latest price, the median price in
+    the trailing window (seconds), and the trend in kr. per 30 days from a least
+    squares fit over all observations. Vectorized over all products at once. """
+    import numpy as np
+    known = ~np.isnan(columns['price'])
+    t, product = columns['time'][known], columns['product'][known]
+    price = columns['price'][known].astype(np.float64)
+
+    # Observations are appended in time order, so a stable sort keeps them that way
+    order = np.argsort(product, kind='stable')
+    products, starts, counts = np.unique(product[order], return_index=True, return_counts=True)
+    latest = price[order][starts + counts - 1]
+
+    # Sorting by (product, price) puts the median of each product in the middle of its run
+    recent = t >= t.max() - window
+    order = np.lexsort((price[recent], product[recent]))
+    sorted_price = price[recent][order]
+    recent_products, r_starts, r_counts = np.unique(
+        product[recent][order], return_index=True, return_counts=True)
+    recent_median = (sorted_price[r_starts + (r_counts - 1) // 2]
+                     + sorted_price[r_starts + r_counts // 2]) / 2
+    median = np.full(len(products), np.nan)
+    median[np.searchsorted(products, recent_products)] = recent_median
+
+    # Slope of price against days, from per product sums
+    group = np.searchsorted(products, product)
+    days = (t - t.min()) / 86400
+
+    def sums(weights):
+        return np.bincount(group, weights=weights, minlength=len(products))
+    n, sx, sy, sxx, sxy = sums(None), sums(days), sums(price), sums(days * days), sums(days * price)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trend = 30 * (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    return products, latest, median, np.nan_to_num(trend)
+
+
+def prices(coop, args):
+    try:
+        import numpy as np
+    except ImportError:
+        sys.exit('pris kræver NumPy: pip install numpy')
+    columns = coop.history.load()
+    if args.term:
+        if args.term.isdigit():
+            pids = [int(args.term)]
+        else:
+            pids = [int(p['id']) for p in coop.find_products(args.term, n=20) if p['id'].isdigit()]
+        mask = np.isin(columns['product'], pids)
+        columns = {name: column[mask] for name, column in columns.items()}
+    if not len(columns['time']):
+        print('Ingen priser set endnu. De bliver gemt når du søger og bruger kurven.')
+        return
+
+    has_price = ~np.isnan(columns['price'])
+    if has_price.any():
+        products, latest, median, trend = price_stats(columns, args.days * 86400)
+        discount = 1 - latest / median
+        best = np.argsort(-np.nan_to_num(discount, nan=-np.inf))[:args.n]
+        names = coop.catalog.names(str(p) for p in products[best])
+        print(bold_text(f'Pris nu mod medianen de sidste {args.days} dage'))
+        for i in best:
+            name = names.get(str(products[i]), str(products[i]))
+            print(f'{name} ({products[i]}): kr. {latest[i]:.2f}, median kr. {median[i]:.2f}, '
+                  f'{100 * discount[i]:+.0f}% rabat, {trend[i]:+.2f} kr. pr. måned')
+        print()
+
+    stocked = (columns['quantity'] >= 0) & (columns['slot'] >= 0)
+    if stocked.any():
+        slot = columns['slot'][stocked]
+        seen = np.bincount(slot)
+        sold_out = np.bincount(slot, weights=columns['quantity'][stocked] == 0)
+        slots = coop.history.slots()
+        print(bold_text('Udsolgt pr. leveringstidspunkt'))
+        for i in np.flatnonzero(seen):
+            slot_id, description = slots[i]
+            print(f'{description or slot_id}: {100 * sold_out[i] / seen[i]:.0f}% '
+                  f'af {seen[i]} opslag')
+
+
 def user(coop, args):
-    res = coop.get_user_context()
+    res = coop.refresh_context()
+    if args.format == 'ndjson':
+        return emit(args, dict(type='user', **res))
     for key, value in res.items():
         print(f'{key}: {value}')
 
 
+class DaemonOutput(io.TextIOBase):
+    """ Sends everything written to it to a coop.py client as it is written.
+    stream is 'out' or 'err'. """
+
+    def __init__(self, f, stream='out'):
+        self.f = f
+        self.stream = stream
+
+    def write(self, text):
+        self.f.write(json.dumps({self.stream: text}) + '\n')
+        self.f.flush()
+        return len(text)
+
+
+def serve_command(coop, conn):
+    """ Runs one command sent by forward_to_daemon """
+    with conn.makefile('rw', encoding='utf-8') as f:
+        request = json.loads(f.readline())
+        exit_code = 0
+        cwd = os.getcwd()
+        with contextlib.redirect_stdout(DaemonOutput(f)), \
+                contextlib.redirect_stderr(DaemonOutput(f, 'err')):
+            try:
+                # File arguments are relative to the directory of the client
+                os.chdir(request['cwd'])
+                args = parser.parse_args(request['argv'])
+                run_command(coop, args)
+            except SystemExit as e:
+                if isinstance(e.code, str):
+                    print(e.code)
+                exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except CoopError as e:
+                print(e)
+                exit_code = 1
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os.chdir(cwd)
+        coop.save_cookies()
+        f.write(json.dumps({'exit': exit_code}) + '\n')
+
+
+def daemon(coop, args):
+    """ Keeps the session, connections and caches alive, and runs the commands
+    of coop.py invocations in this directory one at a time. """
+    path = pathlib.Path(SOCKET_NAME)
+    path.unlink(missing_ok=True)
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(SOCKET_NAME)
+    server.listen()
+    print(f'Kører i baggrunden på {path}. Stop med Ctrl-C.')
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn, contextlib.suppress(OSError):
+                serve_command(coop, conn)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        path.unlink(missing_ok=True)
+
+
+class ThreadOutput(io.TextIOBase):
+    """ Stands in for sys.stdout, sending what each thread prints to its own buffer.
+    The buffer is kept in a context variable, so the threads of fan_out and
+    fan_out_as_completed print to the buffer of the thread that started them. """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.buffer = contextvars.ContextVar('buffer', default=None)
+
+    def capture(self):
+        buffer = io.StringIO()
+        self.buffer.set(buffer)
+        return buffer
+
+    def write(self, text):
+        return (self.buffer.get() or self.stdout).write(text)
+
+
+def run_account(account, base, args):
+    """ Runs the actions of one account from a batch manifest. Returns the output. """
+    cookies_path = base / account['cookies']
+    with open_coop(cookies_path, args) as coop:
+        # Only the manifest may hold the credentials of an account
+        coop.credentials = None
+        if account.get('username') and account.get('password'):
+            coop.credentials = (account['username'], account['password'])
+        if not coop.context['isAuthenticated']:
+            if coop.credentials is None:
+                raise CoopError('Ikke logget ind, og der er ingen username/password i manifestet.')
+            if not coop.login(*coop.credentials):
+                raise CoopError('Forkert username eller password.')
+        for action in account['actions']:
+            argv = shlex.split(action)
+            # Reading and syncing use the list of the account
+            if argv[-1] in ('--read', '--sync'):
+                argv.append(str(base / account['list']))
+            print(bold_text(action))
+            action_args = parser.parse_args(argv)
+            run_command(coop, action_args)
+            print()
+
+
+def batch(coop, args):
+    """ Runs the actions of every account in a manifest concurrently. Results are
+    stored next to the manifest, so accounts that failed can be run again with --resume. """
+    manifest_path = pathlib.Path(args.manifest)
+    base = manifest_path.parent
+    accounts = json.loads(manifest_path.read_text())
+    results_path = manifest_path.with_suffix('.results.json')
+    results = {}
+    if args.resume and results_path.is_file():
+        results = json.loads(results_path.read_text())
+        accounts = [a for a in accounts if not results.get(a['name'], {}).get('ok')]
+    print(f'Kører {len(accounts)} konti...')
+
+    output = ThreadOutput(sys.stdout)
+
+    def run(account):
+        buffer = output.capture()
+        start = time.time()
+        try:
+            run_account(account, base, args)
+            error = None
+        except CoopError as e:
+            error = str(e)
+        except SystemExit as e:
+            # argparse prints its own message
+            error = e.code if isinstance(e.code, str) else 'Ugyldig kommando'
+        except Exception:
+            error = traceback.format_exc()
+        return dict(ok=error is None, error=error, output=buffer.getvalue(),
+                    seconds=round(time.time() - start, 2))
+
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output), \
+            concurrent.futures.ThreadPoolExecutor(args.parallel) as pool:
+        futures = {pool.submit(run, account): account['name'] for account in accounts}
+        for future in concurrent.futures.as_completed(futures):
+            name, result = futures[future], future.result()
+            results[name] = result
+            results_path.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+            status = 'ok' if result['ok'] else 'FEJL'
+            print(bold_text(f'{name}: {status}'), f'({result["seconds"]}s)', file=output.stdout)
+            print(result['output'], file=output.stdout)
+            if result['error']:
+                print(result['error'], file=output.stdout)
+
+    failed = [name for name, result in results.items() if not result['ok']]
+    if failed:
+        print(f'Fejl for {", ".join(failed)}. Kør igen med --resume for at prøve dem igen.')
+        sys.exit(1)
+
+
 def help(coop, args):
     parser.print_help()
 
@@ -554,6 +2374,10 @@ Eksempler:
 Se hjælp: python3 coop.py
 Vælg et tidspunkt
     python3 coop.py tidspunkt --pick
+Vent på at et godt tidspunkt bliver ledigt, og vælg det
+    python3 coop.py tidspunkt --watch --day 2 --hour 18
+Vælg det bedste tidspunkt tirsdag eller torsdag mellem 17 og 19 de næste 3 uger
+    python3 coop.py tidspunkt --pick --day 1 3 --hour 17 19 --weeks 3
 Se hvad der er i kurven
     python3 coop.py kurv
 Slet hvad der er i kurven
@@ -562,14 +2386,49 @@ Skriv hvad der er i kurven til en fil
     python3 coop.py kurv --write FILNAVN
 Tilføj en fil til kurven
     python3 coop.py kurv --read FILNAVN
+Tilføj flere filer til kurven. Filer kan inkludere andre med linjen "#include FILNAVN"
+    python3 coop.py kurv --read basis.csv 'lister/*.csv'
+Gør kurven lig med en fil
+    python3 coop.py kurv --sync FILNAVN
 Se de 10 seneste ordrer
     python3 coop.py ordrer
+Hent alle nye ordrer til den lokale ordrehistorik
+    python3 coop.py ordrer --sync
 Skriv en tidligere ordre til en fil
     python3 coop.py ordrer N --write FILNAVN
+Skriv hele ordrehistorikken til bestillingslister i en mappe
+    python3 coop.py ordrer --export MAPPE
+Foreslå en bestillingsliste ud fra hvad der plejer at blive købt
+    python3 coop.py ordrer --suggest --write FILNAVN
+Se de største rabatter i forhold til de sædvanlige priser
+    python3 coop.py pris
+Se prisudviklingen for en vare
+    python3 coop.py pris VARE
+Kør kommandoer for flere husstande på én gang
+    python3 coop.py batch konti.json
+Hold en session åben i baggrunden, så de andre kommandoer går hurtigere
+    python3 coop.py daemon
 ''', formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument('--debug', action='store_true')
-parser.add_argument('--username', default='')
+parser.add_argument('--username', default='',
+                    help='Defaults to $COOP_USERNAME, cookies.credentials or the keyring')
 parser.add_argument('--password', default='')
+parser.add_argument('--concurrency', type=int, default=8,
+                    help='Max number of requests to run at the same time')
+parser.add_argument('--no-cache', action='store_true',
+                    help="Don't use or update the local response cache")
+parser.add_argument('--timeout', type=float, default=30,
+                    help='Seconds to wait for a response before giving up')
+parser.add_argument('--rate', type=float, default=10,
+                    help='Max number of requests per second on average')
+parser.add_argument('--profile', action='store_true',
+                    help='Print time spent per endpoint and phase when done')
+parser.add_argument('--trace', type=argparse.FileType('w'), metavar='FILE_NAME',
+                    help='Write a Chrome trace (chrome://tracing) of the requests')
+parser.add_argument('--stock-chunk-size', type=int, default=100,
+                    help='Max number of products per stock request')
+parser.add_argument('--format', choices=['text', 'ndjson'], default='text',
+                    help='ndjson writes one json record per line as results arrive')
 parser.set_defaults(func=help)
 subparsers = parser.add_subparsers()
 
@@ -580,11 +2439,39 @@ timeslot_parser.add_argument(
     '--pick',
     action='store_true',
     help='Automatically pick best timeslot')
+timeslot_parser.add_argument(
+    '--watch',
+    action='store_true',
+    help='Wait for a good timeslot to become free, and pick it')
 timeslot_parser.add_argument(
     '--day',
+    type=int,
+    nargs='+',
+    default=[2],
+    choices=range(7),
+    help='Preferred days to autopick. 0 is Monday, 6 is Sunday')
+timeslot_parser.add_argument(
+    '--hour',
+    type=int,
+    nargs='+',
+    default=[18],
+    metavar='HOUR',
+    help='Preferred time to autopick, or an interval FROM TO')
+timeslot_parser.add_argument(
+    '--tolerance',
+    type=int,
+    default=1,
+    help='Hours from the preferred time accepted by --pick and --watch')
+timeslot_parser.add_argument(
+    '--weeks',
+    type=int,
     default=2,
-    help='Preferred day to autopick. 0 is Monday, 6 is Sunday')
-timeslot_parser.add_argument('--hour', default=18, help='Preferred time to autopick')
+    help='Number of weeks ahead to look')
+timeslot_parser.add_argument(
+    '--hour-cost',
+    type=float,
+    metavar='KR',
+    help='Weigh delivery prices in --pick, with an hour from the preferred time costing KR')
 
 test_parser = subparsers.add_parser('test', help=argparse.SUPPRESS)
 test_parser.set_defaults(func=test)
@@ -601,9 +2488,19 @@ basket_parser.add_argument(
     help='Write basket as csv')
 basket_parser.add_argument(
     '--read',
-    type=argparse.FileType('r'),
+    nargs='+',
+    metavar='FILE_NAME',
+    help='Read csv files or glob patterns and add them to the basket')
+basket_parser.add_argument(
+    '--sync',
+    nargs='+',
     metavar='FILE_NAME',
-    help='Read csv and add to basket')
+    help='Make the basket match the csv files, only sending the changes')
+basket_parser.add_argument(
+    '--prefer-cheap',
+    type=float,
+    metavar='KR',
+    help='Take a cheaper alternative when it saves more than KR kr. per step down the list')
 basket_parser.add_argument('--clear', action='store_true', help='Fjern alt fra kurven')
 basket_parser.add_argument(
     '--test',
@@ -617,21 +2514,94 @@ order_parser.add_argument(
     type=argparse.FileType('w'),
     metavar='FILE_NAME',
     help='Write basket as csv')
+order_parser.add_argument(
+    '--sync',
+    action='store_true',
+    help='Download new orders to the local order history')
+order_parser.add_argument(
+    '--suggest',
+    action='store_true',
+    help='Suggest a shopping list from the order history. Use with --write')
+order_parser.add_argument(
+    '--export',
+    metavar='DIRECTORY',
+    help='Write every order in the order history to a csv file in the directory')
 order_parser.set_defaults(func=orders)
 
 search_parser = subparsers.add_parser('search', help='Search for products')
 search_parser.add_argument('term', type=str, help='Search term')
+search_parser.add_argument('--online', action='store_true',
+                           help='Ask Coop instead of searching products seen before')
 search_parser.set_defaults(func=search)
 
+batch_parser = subparsers.add_parser(
+    'batch', help='Kør kommandoer for flere konti på samme tid')
+batch_parser.add_argument(
+    'manifest',
+    help='JSON list of accounts with name, cookies, list, actions and optionally '
+         'username and password. Paths are relative to the manifest.')
+batch_parser.add_argument('--parallel', type=int, default=4,
+                          help='Max number of accounts to run at the same time')
+batch_parser.add_argument('--resume', action='store_true',
+                          help='Only run the accounts that failed last time')
+batch_parser.set_defaults(func=batch)
+
+price_parser = subparsers.add_parser('pris', help='Se priser og lager over tid')
+price_parser.add_argument('term', nargs='?', help='Product id or search term')
+price_parser.add_argument('--days', type=int, default=90,
+                          help='Days back to compute the median price over')
+price_parser.add_argument('-n', type=int, default=10, help='Number of products to show')
+price_parser.set_defaults(func=prices)
+
+daemon_parser = subparsers.add_parser(
+    'daemon', help='Hold sessionen åben, så andre kald til coop.py bliver hurtigere')
+daemon_parser.set_defaults(func=daemon)
+
+
+def open_coop(cookies_path, args, profiler=None):
+    """ A Coop configured by the global command line options """
+    coop = Coop(cookies_path, concurrency=args.concurrency,
+                use_cache=not args.no_cache,
+                stock_chunk_size=args.stock_chunk_size,
+                timeout=args.timeout, rate=args.rate, profiler=profiler)
+    if args.username and args.password:
+        coop.credentials = (args.username, args.password)
+    else:
+        coop.credentials = stored_credentials(cookies_path, args.username)
+    return coop
+
+
+def run_command(coop, args):
+    """ Runs the subcommand of the parsed args. With --format ndjson, the records
+    are written to stdout and everything else is printed to stderr. """
+    with coop.phase(args.func.__name__):
+        if args.format != 'ndjson':
+            return args.func(coop, args)
+        args.records = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            return args.func(coop, args)
+
 
 def main():
     args = parser.parse_args()
+    if args.func is help:
+        # No need to log in just to show the help
+        return help(None, args)
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
+    if args.func is batch:
+        # Every account has its own session
+        return batch(None, args)
     cookies_path = pathlib.Path('cookies.coop')
 
-    print('Logging in...')
-    with Coop(cookies_path) as coop:
+    profiler = Profiler() if args.profile or args.trace else None
+    # Keep stdout for the records
+    messages = sys.stderr if args.format == 'ndjson' else sys.stdout
+    print('Logging in...', file=messages)
+    with open_coop(cookies_path, args, profiler) as coop:
+        if not coop.context['isAuthenticated'] and coop.credentials:
+            if not coop.login(*coop.credentials):
+                print('Mistake in stored username or password', file=messages)
         while not coop.context['isAuthenticated']:
             username, password = args.username, args.password
             while not username:
@@ -640,10 +2610,19 @@ def main():
                 password = input('Password: ').strip()
             success = coop.login(username, password)
             if not success:
-                print('Mistake in username or password')
+                print('Mistake in username or password', file=messages)
 
-        print(f'Hej {coop.context["name"]}!')
-        args.func(coop, args)
+        print(f'Hej {coop.context["name"]}!', file=messages)
+        try:
+            run_command(coop, args)
+        except CoopError as e:
+            print(e, file=messages)
+            sys.exit(1)
+        finally:
+            if args.profile:
+                profiler.print_summary()
+            if args.trace:
+                profiler.write_trace(args.trace)
 
 
 if __name__ == '__main__':
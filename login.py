@@ -0,0 +1,153 @@
+""" Logging in to coop.dk.
+
+The login is a round trip through a few small html pages, each holding one form.
+Forms are found by the fields they contain rather than by their position in the
+page, so changes to the markup around them don't matter. lxml is used to parse
+them if it is installed, and otherwise the html parser of the standard library.
+"""
+import time
+from html.parser import HTMLParser
+from urllib.parse import parse_qs, urlparse
+
+TOKEN_FIELD = '__RequestVerificationToken'
+# Fields of the form that hands the login back to the shop, any of which will do
+CALLBACK_FIELDS = ('code', 'id_token', 'state')
+WRONG_PASSWORD = 'Adgangskoden er forkert'
+# The verification token is reused for later logins in the same session for this
+# long. The server may still reject it, and then a new one is fetched.
+TOKEN_MAX_AGE = 15 * 60
+
+
+class LoginError(Exception):
+    """ A login page didn't look as expected """
+
+
+class Form:
+    def __init__(self, action, method, fields):
+        self.action = action
+        self.method = method
+        self.fields = fields  # Input name -> value
+
+    def __repr__(self):
+        return f'Form({self.action!r}, {self.method!r}, {self.fields!r})'
+
+
+class FormParser(HTMLParser):
+    """ Collects the forms of a page and their input fields """
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self.form = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form':
+            self.form = Form(attrs.get('action'), (attrs.get('method') or 'get').lower(), {})
+            self.forms.append(self.form)
+        elif tag == 'input' and self.form is not None and attrs.get('name'):
+            self.form.fields[attrs['name']] = attrs.get('value') or ''
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self.form = None
+
+
+def parse_forms(text):
+    """ All forms of an html page """
+    try:
+        from lxml import html
+    except ImportError:
+        parser = FormParser()
+        parser.feed(text)
+        parser.close()
+        return parser.forms
+    return [Form(form.get('action'), (form.get('method') or 'get').lower(),
+                 {i.get('name'): i.get('value') or ''
+                  for i in form.iter('input') if i.get('name')})
+            for form in html.fromstring(text).iter('form')]
+
+
+def find_form(text, field=None):
+    """ The first form of the page with an input named field, or the first form
+    at all if field is None. Returns None if there is no such form. """
+    for form in parse_forms(text):
+        if field is None or field in form.fields:
+            return form
+    return None
+
+
+def find_callback_form(text):
+    """ The form of the page that hands the login back to the shop, or None """
+    for form in parse_forms(text):
+        if TOKEN_FIELD not in form.fields and any(f in form.fields for f in CALLBACK_FIELDS):
+            return form
+    return None
+
+
+class LoginFlow:
+    """ Logs a session in. request(method, url, **kwargs) sends a request in the
+    session and returns the response, and phase(name) is a context manager timing
+    the html parsing. """
+
+    def __init__(self, request, start_url, login_url, phase=None):
+        self.request = request
+        self.start_url = start_url
+        self.login_url = login_url
+        self.phase = phase
+        # (token, query params of the login form, time fetched)
+        self.token = None
+
+    def _parse(self, find, *args):
+        if self.phase is None:
+            return find(*args)
+        with self.phase('login html'):
+            return find(*args)
+
+    def fetch_token(self):
+        r = self.request('GET', self.start_url)
+        form = self._parse(find_form, r.text, TOKEN_FIELD)
+        if form is None:
+            raise LoginError('Fandt ikke login-formularen')
+        self.token = (form.fields[TOKEN_FIELD], parse_qs(urlparse(form.action).query),
+                      time.time())
+
+    def login(self, username, password):
+        """ Returns whether the username and password were accepted """
+        reused = self.token is not None and time.time() - self.token[2] < TOKEN_MAX_AGE
+        if not reused:
+            self.fetch_token()
+        token, params, _ = self.token
+        r = self.request('POST', self.login_url, params=params, data={
+            TOKEN_FIELD: token,
+            'UserName': username,
+            'Password': password,
+        })
+        if WRONG_PASSWORD in r.text:
+            return False
+        form = self._parse(find_callback_form, r.text)
+        if form is None:
+            self.token = None
+            if reused:
+                # The server didn't accept the old token after all
+                return self.login(username, password)
+            if self._parse(find_form, r.text, TOKEN_FIELD) is not None:
+                # Back at the login page, so the login failed
+                return False
+            raise LoginError('Uventet svar fra login-siden')
+        self.callback(form)
+        return True
+
+    def callback(self, form):
+        """ Posts the form that hands the login back to the shop """
+        # This call just returns a page asking us to go back
+        # 'window.parent.location.href = window.parent.location.href;'
+        self.request('POST', form.action, data=form.fields)
+
+    def callback_page(self, text):
+        """ Follows a page with the callback form. Returns whether there was one. """
+        form = self._parse(find_callback_form, text)
+        if form is None:
+            return False
+        self.callback(form)
+        return True
@@ -0,0 +1,304 @@
+""" Compact models of the responses from the Coop api.
+
+Responses carry many more fields than coop.py reads. The models keep only the
+fields that are used, in slots rather than a dict per object, which adds up
+when thousands of products and line items are held at once for syncing and
+statistics. They can still be indexed like the dicts they replace, so
+item['product']['displayName'] and product.get('spotText') keep working.
+
+With msgspec installed, the models are msgspec Structs and responses are
+decoded straight into them, skipping the fields that aren't used without
+building them first. Otherwise json is decoded in full, with orjson if it is
+installed, and then copied into the models.
+"""
+import json
+import typing
+from typing import Any, Optional, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """ Decodes json from bytes or str """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """ Encodes json, with models, to bytes """
+    if msgspec is not None:
+        return msgspec.json.encode(obj)
+    if orjson is not None:
+        return orjson.dumps(obj, default=to_json)
+    return json.dumps(obj, ensure_ascii=False, default=to_json).encode()
+
+
+def to_json(obj):
+    """ The json value of a model, for the default argument of json encoders """
+    if isinstance(obj, Fields):
+        return obj.to_json()
+    raise TypeError(f'{type(obj).__name__} is not json serializable')
+
+
+def product_price(product, keys=('salesPrice', 'price', 'unitPrice')):
+    """ The price of a product as a number, or None if the response doesn't have it.
+    Not all responses name the field the same way. """
+    for key in keys:
+        price = product.get(key)
+        if hasattr(price, 'get'):
+            price = price.get('amount')
+        if isinstance(price, (int, float)):
+            return float(price)
+    return None
+
+
+class Fields:
+    """ Dict-like access to the fields of a model """
+    __slots__ = ()
+
+    def to_json(self):
+        return {name: getattr(self, name) for name in self.__struct_fields__}
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __contains__(self, name):
+        return getattr(self, name, None) is not None
+
+
+if msgspec is not None:
+    class Model(msgspec.Struct, Fields):
+        """ Base class of the models. The fields are named like the json fields,
+        and all of them are optional. """
+
+    _decoders = {}
+
+    def decode(data, type):
+        """ Decodes json bytes into type, which is a model or a typing expression
+        of models like list[Product]. Responses that don't fit the type, such as
+        error messages, are decoded as plain json. """
+        decoder = _decoders.get(type)
+        if decoder is None:
+            decoder = _decoders[type] = msgspec.json.Decoder(type)
+        try:
+            return decoder.decode(data)
+        except msgspec.ValidationError:
+            return loads(data)
+else:
+    class ModelType(type):
+        """ Turns the annotated fields of a model into slots """
+
+        def __new__(mcs, name, bases, namespace):
+            fields = tuple(namespace.get('__annotations__', ()))
+            for field in fields:
+                namespace.pop(field, None)
+            namespace['__slots__'] = fields
+            namespace['__struct_fields__'] = fields
+            return super().__new__(mcs, name, bases, namespace)
+
+    class Model(Fields, metaclass=ModelType):
+        """ Base class of the models. The fields are named like the json fields,
+        and all of them are optional. """
+        # Fields that __post_init__ replaces, which are left as decoded
+        raw = ()
+
+        def __init__(self, **fields):
+            for name in self.__struct_fields__:
+                setattr(self, name, fields.get(name))
+            if hasattr(self, '__post_init__'):
+                self.__post_init__()
+
+        def __repr__(self):
+            fields = ', '.join(f'{name}={getattr(self, name)!r}'
+                               for name in self.__struct_fields__)
+            return f'{type(self).__name__}({fields})'
+
+    _converters = {}
+
+    def converter(type):
+        """ A function that copies decoded json into type, or None if the json
+        is kept as it is. Made once for each type. """
+        if type not in _converters:
+            _converters[type] = _make_converter(type)
+        return _converters[type]
+
+    def _make_converter(type):
+        if type is Any:
+            return None
+        origin = typing.get_origin(type)
+        if origin is None:
+            return _model_converter(type)
+        if origin is list:
+            item = converter(typing.get_args(type)[0])
+            if item is None:
+                return None
+            return lambda value: [item(v) for v in value] if isinstance(value, list) else value
+        # A union holds at most one list and one model, so the json value picks one
+        from_list = from_dict = None
+        for arg in typing.get_args(type):
+            if typing.get_origin(arg) is list:
+                from_list = converter(arg)
+            elif isinstance(arg, ModelType):
+                from_dict = converter(arg)
+        from_list = from_list or (lambda value: value)
+        from_dict = from_dict or (lambda value: value)
+        return lambda value: (from_dict(value) if isinstance(value, dict) else
+                              from_list(value) if isinstance(value, list) else value)
+
+    def _model_converter(cls):
+        fields = []
+        post_init = getattr(cls, '__post_init__', None)
+        new = cls.__new__
+
+        def convert(data):
+            if not isinstance(data, dict):
+                return data
+            obj = new(cls)
+            get = data.get
+            for name, field in fields:
+                value = get(name)
+                setattr(obj, name, value if field is None or value is None else field(value))
+            if post_init is not None:
+                post_init(obj)
+            return obj
+        # Nested models may refer back, so the fields are filled in last
+        _converters[cls] = convert
+        fields.extend((name, None if name in cls.raw else converter(tp))
+                      for name, tp in cls.__annotations__.items())
+        return convert
+
+    def decode(data, type):
+        """ Decodes json bytes into type, which is a model or a typing expression
+        of models like list[Product] """
+        convert = converter(type)
+        data = loads(data)
+        return data if convert is None or data is None else convert(data)
+
+
+class Amount(Model):
+    amount: Any = None
+
+
+class Label(Model):
+    displayName: Any = None
+
+
+class Product(Model):
+    id: Any = None
+    displayName: Any = None
+    category: Any = None
+    spotText: Any = None
+    # The display names of the labels, once decoded
+    labels: Optional[list[Union[Label, str]]] = None
+    # The price as a number, once decoded
+    price: Union[Amount, float, str, None] = None
+    salesPrice: Union[Amount, float, str, None] = None
+    unitPrice: Union[Amount, float, str, None] = None
+    isInAssortment: Any = None
+    url: Any = None
+    raw = ('labels', 'price', 'salesPrice', 'unitPrice')
+
+    def __post_init__(self):
+        self.price = product_price(self)
+        self.salesPrice = self.unitPrice = None
+        if self.labels is not None:
+            self.labels = [l if isinstance(l, str) else l['displayName'] for l in self.labels]
+
+
+class ProductList(Model):
+    """ Product lists come both bare and wrapped in this """
+    products: Optional[list[Product]] = None
+
+
+# Responses with products
+Products = Union[ProductList, list[Product]]
+
+
+class LineItem(Model):
+    """ A line of the basket, which has a product, or of an order in the order
+    history, which only has a name and an image """
+    quantity: Any = None
+    product: Optional[Product] = None
+    displayName: Any = None
+    imageUrl: Any = None
+
+
+class StockEntry(Model):
+    itemId: Any = None
+    quantity: Any = None
+    label: Any = None
+    cutOffDate: Any = None
+    cutOffExceeded: Any = None
+    date: Any = None
+
+
+class TimeSlot(Model):
+    timeSlotId: Any = None
+    displayName: Any = None
+    deliveryDescription: Any = None
+    soldOut: Any = None
+    isSpecialSlot: Any = None
+    # The delivery price as a number, or None if the response has no price. The
+    # field names are a guess that hasn't been confirmed in a real response.
+    price: Union[Amount, float, str, None] = None
+    deliveryPrice: Union[Amount, float, str, None] = None
+    raw = ('price', 'deliveryPrice')
+
+    def __post_init__(self):
+        self.price = product_price(self, ('deliveryPrice', 'price'))
+        self.deliveryPrice = None
+
+
+class TimeSlotDay(Model):
+    deliveryDate: Any = None
+    deliveryDateFormattedLong: Any = None
+    timeSlots: Optional[list[TimeSlot]] = None
+
+
+class TimeSlots(Model):
+    timeSlotDeliveryDays: Optional[list[TimeSlotDay]] = None
+
+
+class Basket(Model):
+    id: Any = None
+    orderIdentifier: Any = None
+    lineItems: Optional[list[LineItem]] = None
+    timeSlot: Optional[TimeSlot] = None
+    store: Any = None
+    totals: Any = None
+    progressBar: Any = None
+    messages: Any = None
+    deliveryCheckoutMessage: Any = None
+
+
+class Order(Model):
+    """ An order in the list of invoiced orders """
+    orderIdentifier: Any = None
+    orderNumber: Any = None
+    deliveryTime: Any = None
+    price: Any = None
+    isEditable: Any = None
+
+
+class Category(Model):
+    name: Any = None
+    lineItems: Optional[list[LineItem]] = None
+
+
+class OrderDetail(Model):
+    categories: Optional[list[Category]] = None